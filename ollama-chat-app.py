@@ -3,12 +3,31 @@ import requests
 import json
 import time
 from datetime import datetime
-import re
 from typing import List, Dict, Any, Optional
 import base64
 import io
 import os
 import pickle
+import sqlite3
+import threading
+import hashlib
+import uuid
+import re
+import socket
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import pandas as pd
+import numpy as np
+
+from ollama_chat_core import (
+    Message, ConversationTree, compress_blob, decompress_blob, unpack_messages, tree_from_storage,
+    LocalFileBackend, RedisBackend, WriteBatcher, SessionStore, ThinkingStreamParser, GenerationScheduler, file_lock
+)
 
 # Page config
 st.set_page_config(
@@ -62,18 +81,346 @@ CONVERSATION_TEMPLATES = {
     }
 }
 
+# Streaming render defaults
+DEFAULT_RENDER_INTERVAL_MS = 75
+RENDER_MAX_PENDING_CHARS = 1500  # flush early if this much text is waiting, so bursts never lag far behind
+
+# Ollama client
+DEFAULT_OLLAMA_URL = os.environ.get("OLLAMA_CHAT_NODES") or os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+# Letting visitors pick the servers lets them aim this process's requests at any host, so it is opt-in
+ALLOW_URL_OVERRIDE = os.environ.get("OLLAMA_CHAT_ALLOW_URL_OVERRIDE", "").lower() in ("1", "true", "yes")
+CONNECT_TIMEOUT = 3.05      # seconds to establish a TCP connection
+READ_TIMEOUT = 10           # seconds to wait for a regular API response
+STREAM_READ_TIMEOUT = 300   # max silence between streamed chunks (covers cold model loads)
+CONNECTION_POOL_SIZE = 16
+
+def normalize_base_url(base_url):
+    """Accept OLLAMA_HOST-style values like '0.0.0.0:11434' as well as full URLs"""
+    base_url = (base_url or "").strip().rstrip('/') or "http://localhost:11434"
+    if '://' not in base_url:
+        base_url = f"http://{base_url}"
+    return base_url.replace('://0.0.0.0', '://localhost')
+
+def parse_node_urls(value):
+    """Ollama base URLs from a comma or space separated list, normalized and de-duplicated"""
+    urls = []
+    for part in re.split(r'[,\s]+', value or ''):
+        url = normalize_base_url(part)
+        if part and url not in urls:
+            urls.append(url)
+    return tuple(urls) or (normalize_base_url(''),)
+
+# Set by OllamaClient.chat for the duration of the request on this thread
+_connection_watch = threading.local()
+
+class WatchedPoolMixin:
+    """Connection pool that reports each connection it hands out to this thread's watcher
+
+    _get_conn is private to urllib3, so requirements.txt pins the major versions it was checked against.
+    """
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        watcher = getattr(_connection_watch, 'callback', None)
+        if watcher is not None:
+            watcher(conn)
+        return conn
+
+class WatchedHTTPConnectionPool(WatchedPoolMixin, HTTPConnectionPool):
+    pass
+
+class WatchedHTTPSConnectionPool(WatchedPoolMixin, HTTPSConnectionPool):
+    pass
+
+class WatchedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools report connections, so a request can be aborted while it waits for headers"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': WatchedHTTPConnectionPool, 'https': WatchedHTTPSConnectionPool
+        }
+
+def abort_connection(conn):
+    """Shut down a connection's socket, so a read blocked on it in another thread returns at once"""
+    sock = getattr(conn, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # already closed
+
+class OllamaClient:
+    """Ollama API client sharing one keep-alive connection pool across reruns and threads"""
+
+    def __init__(self, base_url, pool_size=CONNECTION_POOL_SIZE):
+        self.base_url = normalize_base_url(base_url)
+        self.timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        self.stream_timeout = (CONNECT_TIMEOUT, STREAM_READ_TIMEOUT)
+        self.session = requests.Session()
+        adapter = WatchedHTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, path, stream=False, timeout=None, **kwargs):
+        """Send a request to the Ollama API using the pooled session"""
+        if timeout is None:
+            timeout = self.stream_timeout if stream else self.timeout
+        return self.session.request(method, f"{self.base_url}{path}", stream=stream, timeout=timeout, **kwargs)
+
+    def tags(self, timeout=None):
+        return self.request('GET', '/api/tags', timeout=timeout)
+
+    def chat(self, payload, on_connection=None):
+        """POST /api/chat; on_connection is called with the connection the request goes out on"""
+        _connection_watch.callback = on_connection
+        try:
+            return self.request('POST', '/api/chat', json=payload, stream=payload.get('stream', False))
+        finally:
+            _connection_watch.callback = None
+
+    def pull(self, model_name):
+        return self.request('POST', '/api/pull', json={"name": model_name, "stream": True}, stream=True)
+
+    def delete(self, model_name):
+        return self.request('DELETE', '/api/delete', json={"name": model_name})
+
+    def show(self, model_name):
+        return self.request('POST', '/api/show', json={"model": model_name})
+
+    def embed(self, model_name, text):
+        return self.request('POST', '/api/embed', json={"model": model_name, "input": text})
+
+    def ps(self, timeout=None):
+        return self.request('GET', '/api/ps', timeout=timeout)
+
+    def load(self, model_name, keep_alive=None, num_ctx=None):
+        """Load a model into memory without generating anything (a chat request with no messages)"""
+        payload = {"model": model_name, "messages": []}
+        if keep_alive is not None:
+            payload['keep_alive'] = keep_alive
+        if num_ctx is not None:
+            payload['options'] = {'num_ctx': num_ctx}
+        return self.request('POST', '/api/chat', json=payload, timeout=self.stream_timeout)
+
+@st.cache_resource(show_spinner=False)
+def get_ollama_client(base_url):
+    """One pooled client per Ollama base URL, shared by every session in this process"""
+    return OllamaClient(base_url)
+
+# Ollama health/model probe
+PROBE_TTL = 15  # seconds a probe result is served before a background refresh
+PROBE_BACKOFF_BASE = 2  # first re-check of a failing server, doubling on every further failure
+PROBE_BACKOFF_MAX = 60
+
+class OllamaProbe:
+    """Process-wide cache of Ollama health and installed models from a single /api/tags call"""
+
+    def __init__(self, client, ttl=PROBE_TTL):
+        self.client = client
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.result = None
+        self.checked_at = 0.0
+        self.refreshing = False
+        self.failures = 0  # consecutive failed checks or requests
+
+    def fetch(self):
+        """Probe Ollama once, returning health, status message and model list together"""
+        try:
+            response = self.client.tags(timeout=(CONNECT_TIMEOUT, 3))
+            if response.status_code == 200:
+                models = response.json().get('models', [])
+                loaded = self.fetch_loaded()
+                return {
+                    'connected': True, 'status': "Connected", 'error': None,
+                    'models': sorted([model['name'] for model in models]),
+                    'details': {model['name']: model for model in models},
+                    'loaded': [model['name'] for model in loaded],
+                    'loaded_details': loaded
+                }
+            return self.failed(f"HTTP {response.status_code}", 'http')
+        except requests.exceptions.ConnectionError:
+            return self.failed("Connection refused - Is Ollama running?", 'connection')
+        except requests.exceptions.Timeout:
+            return self.failed("Connection timeout", 'timeout')
+        except Exception as e:
+            return self.failed(f"Error: {str(e)}", 'unexpected')
+
+    def fetch_loaded(self):
+        """The models the server holds in memory (/api/ps); empty if that call fails"""
+        try:
+            response = self.client.ps(timeout=(CONNECT_TIMEOUT, 3))
+            response.raise_for_status()
+            return response.json().get('models', [])
+        except (requests.exceptions.RequestException, ValueError):
+            return []
+
+    @staticmethod
+    def failed(status, error):
+        return {'connected': False, 'status': status, 'error': error, 'models': [], 'details': {}, 'loaded': [],
+                'loaded_details': []}
+
+    def refresh(self):
+        """Probe synchronously and store the result"""
+        result = self.fetch()
+        with self.lock:
+            self.result = result
+            self.checked_at = time.time()
+            self.refreshing = False
+            self.failures = 0 if result['connected'] else self.failures + 1
+        return result
+
+    def recheck_after(self):
+        """Seconds a result is served: the TTL while healthy, a growing backoff while the server keeps failing"""
+        if not self.failures:
+            return self.ttl
+        return min(PROBE_BACKOFF_MAX, PROBE_BACKOFF_BASE * 2 ** (self.failures - 1))
+
+    def mark_down(self, status):
+        """Record a failed request, so the server is skipped until a backed-off re-check succeeds"""
+        with self.lock:
+            self.result = self.failed(status, 'connection')
+            self.checked_at = time.time()
+            self.failures += 1
+
+    def get(self, wait=True):
+        """Cached result; stale results are returned immediately while a background refresh runs
+
+        Without a result yet, the server is probed now, or None is returned when wait is False.
+        """
+        with self.lock:
+            result = self.result
+            stale = result is not None and time.time() - self.checked_at >= self.recheck_after()
+            if stale and not self.refreshing:
+                self.refreshing = True
+                threading.Thread(target=self.refresh, name="ollama-probe", daemon=True).start()
+        if result is None and wait:
+            return self.refresh()
+        return result
+
+    def invalidate(self):
+        """Forget the cached result so the next call probes Ollama again"""
+        with self.lock:
+            self.result = None
+
+@st.cache_resource(show_spinner=False)
+def get_ollama_probe(base_url):
+    """One shared probe per Ollama base URL"""
+    return OllamaProbe(get_ollama_client(base_url))
+
+# Ollama node pool
+class OllamaNode:
+    """One server of a pool: its pooled client, health probe and the requests it is serving"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.client = get_ollama_client(base_url)
+        self.probe = get_ollama_probe(base_url)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+    @contextmanager
+    def track(self):
+        """Count a request as in flight on this node while the block runs"""
+        with self.lock:
+            self.in_flight += 1
+        try:
+            yield self.client
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+@st.cache_resource(show_spinner=False)
+def get_ollama_node(base_url):
+    """One node per base URL, so in-flight counts cover every session using it"""
+    return OllamaNode(base_url)
+
+class OllamaRouter:
+    """Sends each model's requests to a healthy node that has it, preferring nodes with it loaded and least busy
+
+    get() and invalidate() mirror OllamaProbe, aggregated over the pool.
+    """
+
+    def __init__(self, urls):
+        self.nodes = [get_ollama_node(url) for url in urls]
+
+    def node_results(self, cached_only=False):
+        """(node, probe result) pairs; nodes that were never probed are probed in parallel, or left out if cached_only"""
+        if cached_only:
+            results = [(node, node.probe.get(wait=False)) for node in self.nodes]
+            return [(node, result) for node, result in results if result is not None]
+        unprobed = [node for node in self.nodes if node.probe.result is None]
+        if len(unprobed) > 1:
+            threads = [threading.Thread(target=node.probe.refresh, daemon=True) for node in unprobed]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return [(node, node.probe.get()) for node in self.nodes]
+
+    def get(self):
+        """Pool-wide health and the models installed on any healthy node"""
+        results = [result for _, result in self.node_results()]
+        healthy = [result for result in results if result['connected']]
+        if not healthy:
+            return results[0]
+        details = {}
+        for result in healthy:
+            for name, model in result['details'].items():
+                details.setdefault(name, model)
+        status = "Connected" if len(results) == 1 else f"Connected to {len(healthy)} of {len(results)} nodes"
+        return {'connected': True, 'status': status, 'error': None, 'models': sorted(details), 'details': details,
+                'loaded': sorted({name for result in healthy for name in result['loaded']})}
+
+    def invalidate(self):
+        for node in self.nodes:
+            node.probe.invalidate()
+
+    def probed(self):
+        """Whether every node has a probe result, so cached_only picks see the whole pool"""
+        return all(node.probe.result is not None for node in self.nodes)
+
+    def healthy_nodes(self, model=None):
+        """Healthy nodes, limited to those that have model installed when given"""
+        return [node for node, result in self.node_results()
+                if result['connected'] and (model is None or model in result['details'])]
+
+    def pick(self, model, exclude=(), available=None, cached_only=False):
+        """Best node for model, or None; a node whose last probe did not list the model is only a last resort
+
+        available, if given, further limits the choice to nodes it accepts (e.g. ones with a free slot).
+        cached_only never waits on a probe, for callers holding a lock other threads need.
+        """
+        candidates = [(node, result) for node, result in self.node_results(cached_only)
+                      if result['connected'] and node not in exclude]
+        candidates = [(node, result) for node, result in candidates if model in result['details']] or candidates
+        if available is not None:
+            candidates = [(node, result) for node, result in candidates if available(node)]
+        if not candidates:
+            return None
+        node, _ = min(candidates, key=lambda candidate: (model not in candidate[1]['loaded'],
+                                                         candidate[0].in_flight,
+                                                         len(candidate[1]['loaded'])))
+        return node
+
+    def mark_down(self, node, status):
+        node.probe.mark_down(status)
+
+@st.cache_resource(show_spinner=False)
+def get_ollama_router(urls):
+    return OllamaRouter(urls)
+
+def ollama_router():
+    """Router over the configured Ollama servers, or this session's own choice where that is allowed"""
+    urls = st.session_state.get('ollama_base_url', DEFAULT_OLLAMA_URL) if ALLOW_URL_OVERRIDE else DEFAULT_OLLAMA_URL
+    return get_ollama_router(parse_node_urls(urls))
+
 # Enhanced connection status check
 def check_ollama_connection():
     """Check if Ollama is running and accessible"""
-    try:
-        response = requests.get("http://localhost:11434/api/tags", timeout=3)
-        return response.status_code == 200, "Connected"
-    except requests.exceptions.ConnectionError:
-        return False, "Connection refused - Is Ollama running?"
-    except requests.exceptions.Timeout:
-        return False, "Connection timeout"
-    except Exception as e:
-        return False, f"Error: {str(e)}"
+    probe = ollama_router().get()
+    return probe['connected'], probe['status']
 
 # Message history and navigation functions
 def generate_conversation_summary(messages):
@@ -90,80 +437,244 @@ def generate_conversation_summary(messages):
         return first_message[:47] + "..."
     return first_message or "Untitled conversation"
 
+class ConversationFingerprint:
+    """Rolling sha256 over a conversation's messages, extended by only the messages appended since the last update"""
+
+    def __init__(self):
+        self.digest = ''
+        self.count = 0
+        self.tail = None  # last message folded in; a different object at that position means the list was rewritten
+
+    def update(self, messages):
+        """Fold in new messages; returns False if the list was rewritten and the digest rebuilt from scratch"""
+        appended = self.count <= len(messages) and (self.count == 0 or messages[self.count - 1] is self.tail)
+        if not appended:
+            self.digest, self.count = '', 0
+        for message in messages[self.count:]:
+            encoded = json.dumps(message.to_dict(), sort_keys=True, separators=(',', ':'))
+            self.digest = hashlib.sha256((self.digest + encoded).encode('utf-8')).hexdigest()
+        self.count = len(messages)
+        self.tail = messages[-1] if messages else None
+        return appended
+
+def refresh_messages():
+    """Re-derive the flat active-branch message list after the tree changed"""
+    st.session_state.messages = st.session_state.tree.messages()
+
+def start_new_conversation(conversation_id=None, tree=None):
+    """Switch the session to a new (or the given) conversation with a persistent id"""
+    st.session_state.conversation_id = conversation_id or uuid.uuid4().hex
+    st.session_state.fingerprint = ConversationFingerprint()
+    st.session_state.tree = tree or ConversationTree()
+    refresh_messages()
+
+def history_entry(digest=None):
+    """History metadata of the conversation on screen"""
+    if not st.session_state.conversation_id:
+        start_new_conversation(tree=st.session_state.tree)
+    return {
+        'id': st.session_state.conversation_id,
+        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'summary': generate_conversation_summary(st.session_state.messages),
+        'model': (st.session_state.get('selected_models') or [''])[0],
+        'message_count': len(st.session_state.tree.message_log),
+        'digest': digest
+    }
+
+def current_history_entry():
+    """Entry for the conversation on screen, listed and searched from session state since its saved copy lags behind"""
+    if not st.session_state.messages:
+        return None
+    return dict(history_entry(), current=True)
+
 def save_conversation_history():
-    """Save conversation to history for navigation"""
-    if 'conversation_history' not in st.session_state:
-        st.session_state.conversation_history = []
-    
+    """Save the conversation to history for navigation, when the user leaves it (clear, load, export)
+
+    The session journal already holds the current conversation turn by turn, so its transcript is only
+    written once per visit rather than after every reply; until then the history list and search show
+    the conversation from session state (see current_history_entry).
+    """
     if st.session_state.messages:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        summary = generate_conversation_summary(st.session_state.messages)
-        
-        # Check if this conversation already exists in history (avoid duplicates)
-        conversation_id = hash(str(st.session_state.messages))
-        existing = next((conv for conv in st.session_state.conversation_history if conv.get('id') == conversation_id), None)
-        
-        if not existing:
-            conversation_data = {
-                'id': conversation_id,
-                'timestamp': timestamp,
-                'summary': summary,
-                'messages': st.session_state.messages.copy(),
-                'system_prompt': st.session_state.get('system_prompt', ''),
-                'model': st.session_state.get('selected_models', [''])[0]
+        if not st.session_state.conversation_id:
+            start_new_conversation(tree=st.session_state.tree)
+        conversation_id = st.session_state.conversation_id
+        tree = st.session_state.tree
+        # Fingerprint every message of every branch, plus which branch is active
+        appended = st.session_state.fingerprint.update(tree.message_log)
+        digest = f"{st.session_state.fingerprint.digest}:{tree.leaf}"
+        journal = conversation_journal()
+        # Unchanged since the last save (avoid duplicates); otherwise the entry is updated in place
+        existing = journal.get_history(conversation_id)
+        if not existing or existing.get('digest') != digest:
+            entry = history_entry(digest)
+            transcript = {
+                'tree': tree.to_dict(),
+                'system_prompt': st.session_state.get('system_prompt', '')
             }
-            st.session_state.conversation_history.insert(0, conversation_data)
-            
-            # Keep only last 20 conversations
-            st.session_state.conversation_history = st.session_state.conversation_history[:20]
+            journal.put_history(entry, transcript)
+            index_conversation(conversation_id, tree.message_log, reindex=not appended)
+            enforce_history_budget(keep=conversation_id)
+
+def enforce_history_budget(keep=None):
+    """Evict least recently used conversations beyond HISTORY_BYTE_BUDGET, along with their search entries"""
+    for evicted_id in conversation_journal().evict_history(HISTORY_BYTE_BUDGET, keep=keep):
+        get_search_index().delete(session_key(), evicted_id)
 
 def load_conversation_from_history(conversation):
-    """Load a conversation from history"""
-    st.session_state.messages = conversation['messages'].copy()
-    st.session_state.system_prompt = conversation.get('system_prompt', '')
+    """Load a conversation from history, fetching its transcript on demand"""
+    # The conversation being left goes into history first (it may be the one being loaded)
+    save_conversation_history()
+    transcript = conversation_journal().load_transcript(conversation['id'])
+    if transcript is None:
+        st.error("This conversation's transcript is no longer available")
+        return False
+    # A running generation belongs to the conversation being replaced
+    cancel_generation()
+    st.session_state.active_generation = None
+    st.session_state.system_prompt = transcript.get('system_prompt', '')
+    # Continuing a loaded conversation updates its existing history entry
+    start_new_conversation(conversation['id'], transcript['tree'])
+    conversation_journal().touch_history(conversation['id'])
     if conversation.get('model'):
         st.session_state.selected_models = [conversation['model']]
+    return True
 
 # Persistence functions
-def save_conversation_state():
-    """Save the current conversation state to a file"""
+CACHE_DIR = '.streamlit_cache'
+DEFAULT_EMBED_MODEL = os.environ.get('OLLAMA_CHAT_EMBED_MODEL', 'nomic-embed-text:latest')
+SESSIONS_DIR = os.path.join(CACHE_DIR, 'sessions')
+LEGACY_STATE_PATH = os.path.join(CACHE_DIR, 'conversation_state.pkl')
+HISTORY_PAGE_SIZE = 10
+HISTORY_BYTE_BUDGET = int(os.environ.get('OLLAMA_CHAT_HISTORY_BUDGET_MB', '64')) * 1024 * 1024  # compressed transcripts per session
+STORAGE_URL = os.environ.get('OLLAMA_CHAT_STORAGE', '')  # empty: local files under SESSIONS_DIR
+# Without sign-in every visitor shares one session unless each visit is given its own id in the URL
+SESSION_PER_VISIT = os.environ.get('OLLAMA_CHAT_SESSION_PER_VISIT', '').lower() in ("1", "true", "yes")
+DEFAULT_SESSION_KEY = 'default'
+
+SETTINGS_DEFAULTS = {
+    'system_prompt': "You are a helpful assistant.",
+    'temperature': 0.7,
+    'top_p': 0.9,
+    'max_tokens': 2048,
+    'native_thinking': True,
+    'preload_models': True,
+    'keep_alive': {},
+    'render_interval_ms': DEFAULT_RENDER_INTERVAL_MS,
+    'delta_streaming': True,
+    'theme': 'dark',
+    'ollama_base_url': DEFAULT_OLLAMA_URL,
+    'comparison_mode': False,
+    'max_parallel_streams': 4,
+    'response_cache': False,
+    'semantic_cache': False,
+    'semantic_threshold': 0.95,
+    'embedding_model': DEFAULT_EMBED_MODEL,
+    'selected_models': [],
+    'conversation_id': None  # persistent id of the current conversation's history entry
+}
+
+def current_settings():
+    """Snapshot of the persisted settings in session state"""
+    return {key: st.session_state.get(key, default) for key, default in SETTINGS_DEFAULTS.items()}
+
+def apply_settings(settings):
+    """Restore persisted settings into session state, falling back to defaults"""
+    for key, default in SETTINGS_DEFAULTS.items():
+        value = settings.get(key, default)
+        st.session_state[key] = value.copy() if isinstance(value, (dict, list)) else value
+
+@st.cache_resource(show_spinner=False)
+def get_storage_backend(url=STORAGE_URL):
+    """Local files by default; OLLAMA_CHAT_STORAGE may name another directory or a shared redis:// URL"""
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(url)
+    return LocalFileBackend(url or SESSIONS_DIR)
+
+@st.cache_resource(show_spinner=False)
+def get_write_batcher():
+    return WriteBatcher()
+
+@st.cache_resource(show_spinner=False)
+def get_session_store(url=STORAGE_URL):
+    """Process-wide session store, so concurrent reruns of one session share a journal and its lock"""
+    return SessionStore(get_storage_backend(url), get_write_batcher())
+
+def session_key():
+    """Storage key: the signed-in user when auth is configured, else the sid in the URL, else the shared default"""
+    if 'session_key' not in st.session_state:
+        email = None
+        try:
+            if st.user.is_logged_in:
+                email = st.user.email
+        except Exception:
+            pass  # auth not configured or unsupported by this Streamlit version
+        if email:
+            key = 'user-' + hashlib.sha256(email.lower().encode('utf-8')).hexdigest()[:32]
+        else:
+            key = st.query_params.get('sid', '')
+            if not (key.isascii() and key.isalnum() and 8 <= len(key) <= 64):
+                if SESSION_PER_VISIT:
+                    key = uuid.uuid4().hex
+                    st.query_params['sid'] = key
+                else:
+                    key = DEFAULT_SESSION_KEY
+        st.session_state.session_key = key
+    return st.session_state.session_key
+
+def conversation_journal():
+    return get_session_store().journal(session_key())
+
+def migrate_legacy_state(journal):
+    """Fold the pre-journal shared pickle file into this session's journal, if nobody claimed it yet"""
+    claimed_path = LEGACY_STATE_PATH + '.migrated'
     try:
-        os.makedirs('.streamlit_cache', exist_ok=True)
-        state_data = {
-            'messages': st.session_state.messages,
-            'system_prompt': st.session_state.system_prompt,
-            'temperature': st.session_state.temperature,
-            'top_p': st.session_state.top_p,
-            'max_tokens': st.session_state.max_tokens,
-            'theme': st.session_state.theme,
-            'comparison_mode': st.session_state.comparison_mode,
-            'selected_models': st.session_state.selected_models,
-            'conversation_history': st.session_state.get('conversation_history', []),
-            'timestamp': datetime.now().isoformat()
+        os.replace(LEGACY_STATE_PATH, claimed_path)  # atomic, so exactly one session migrates it
+    except FileNotFoundError:
+        return None
+    with open(claimed_path, 'rb') as f:
+        state_data = pickle.load(f)
+    journal.replace_state({
+        'settings': {key: state_data[key] for key in SETTINGS_DEFAULTS if key in state_data},
+        'tree': ConversationTree.from_messages(unpack_messages(state_data.get('messages', []))),
+        'history': {}
+    })
+    # Oldest first, so the most recent conversation ends up on top
+    for conv in reversed(state_data.get('conversation_history', [])):
+        entry = {
+            'id': str(conv['id']),
+            'timestamp': conv['timestamp'],
+            'summary': conv['summary'],
+            'model': conv.get('model', ''),
+            'message_count': len(conv['messages'])
         }
-        with open('.streamlit_cache/conversation_state.pkl', 'wb') as f:
-            pickle.dump(state_data, f)
+        journal.put_history(entry, {
+            'tree': ConversationTree.from_messages(unpack_messages(conv['messages'])).to_dict(),
+            'system_prompt': conv.get('system_prompt', '')
+        })
+    return journal.state
+
+def save_conversation_state():
+    """Journal whatever changed in the conversation state since the last save"""
+    try:
+        journal = conversation_journal()
+        journal.sync(st.session_state.tree, current_settings())
+        if journal.write_error:
+            raise journal.write_error
     except Exception as e:
         st.error(f"Failed to save conversation state: {e}")
 
 def load_conversation_state():
-    """Load the conversation state from file"""
+    """Load the conversation state from the journal"""
     try:
-        if os.path.exists('.streamlit_cache/conversation_state.pkl'):
-            with open('.streamlit_cache/conversation_state.pkl', 'rb') as f:
-                state_data = pickle.load(f)
-                
+        journal = conversation_journal()
+        state_data = journal.load()
+        if state_data is None and os.path.exists(LEGACY_STATE_PATH):
+            state_data = migrate_legacy_state(journal)
+        if state_data is not None:
             # Restore state
-            st.session_state.messages = state_data.get('messages', [])
-            st.session_state.system_prompt = state_data.get('system_prompt', "You are a helpful assistant.")
-            st.session_state.temperature = state_data.get('temperature', 0.7)
-            st.session_state.top_p = state_data.get('top_p', 0.9)
-            st.session_state.max_tokens = state_data.get('max_tokens', 2048)
-            st.session_state.theme = state_data.get('theme', 'dark')
-            st.session_state.comparison_mode = state_data.get('comparison_mode', False)
-            st.session_state.selected_models = state_data.get('selected_models', [])
-            st.session_state.conversation_history = state_data.get('conversation_history', [])
-            
+            st.session_state.tree = state_data['tree'].clone()
+            refresh_messages()
+            apply_settings(state_data['settings'])
             return True
     except Exception as e:
         st.error(f"Failed to load conversation state: {e}")
@@ -172,8 +683,7 @@ def load_conversation_state():
 def clear_conversation_state():
     """Clear the saved conversation state"""
     try:
-        if os.path.exists('.streamlit_cache/conversation_state.pkl'):
-            os.remove('.streamlit_cache/conversation_state.pkl')
+        conversation_journal().clear()
     except Exception as e:
         st.error(f"Failed to clear conversation state: {e}")
 
@@ -182,15 +692,11 @@ if 'initialized' not in st.session_state:
     # Try to load saved state first
     if not load_conversation_state():
         # Initialize with defaults if no saved state
+        st.session_state.tree = ConversationTree()
         st.session_state.messages = []
-        st.session_state.comparison_mode = False
-        st.session_state.selected_models = []
-        st.session_state.system_prompt = "You are a helpful assistant."
-        st.session_state.temperature = 0.7
-        st.session_state.top_p = 0.9
-        st.session_state.max_tokens = 2048
-        st.session_state.theme = 'dark'
-        st.session_state.conversation_history = []  # Initialize conversation history
+        apply_settings({})
+    st.session_state.history_page = 0
+    st.session_state.fingerprint = ConversationFingerprint()  # rebuilt once from the restored messages
     st.session_state.show_thinking = {}
     st.session_state.initialized = True
 
@@ -713,50 +1219,56 @@ def apply_custom_css():
 
 # Ollama API functions
 def get_available_models():
-    """Fetch available models from Ollama with enhanced error handling"""
-    try:
-        response = requests.get('http://localhost:11434/api/tags', timeout=5)
-        if response.status_code == 200:
-            models = response.json().get('models', [])
-            return sorted([model['name'] for model in models])
-        else:
-            st.error(f"Failed to fetch models. HTTP {response.status_code}")
-            return []
-    except requests.exceptions.ConnectionError:
-        st.error("❌ Cannot connect to Ollama. Please make sure Ollama is running on localhost:11434")
+    """Fetch available models from the cached Ollama probe with enhanced error handling"""
+    router = ollama_router()
+    probe = router.get()
+    if probe['error'] == 'http':
+        st.error(f"Failed to fetch models. {probe['status']}")
+    elif probe['error'] == 'connection':
+        urls = ", ".join(node.base_url for node in router.nodes)
+        st.error(f"❌ Cannot connect to Ollama. Please make sure Ollama is running on {urls}")
         st.info("💡 Try running: `ollama serve` in your terminal")
-        return []
-    except requests.exceptions.Timeout:
+    elif probe['error'] == 'timeout':
         st.error("⏱️ Connection to Ollama timed out. Please check if Ollama is responding.")
-        return []
-    except Exception as e:
-        st.error(f"❌ Unexpected error fetching models: {str(e)}")
-        return []
+    elif probe['error']:
+        st.error(f"❌ Unexpected error fetching models: {probe['status']}")
+    return probe['models']
 
 def pull_model(model_name, progress_bar):
-    """Pull a model from Ollama"""
+    """Pull a model onto every healthy Ollama node, so any of them can serve it"""
+    router = ollama_router()
+    nodes = router.healthy_nodes()
+    if not nodes:
+        st.error("Error pulling model: no Ollama node is reachable")
+        return
     try:
-        url = 'http://localhost:11434/api/pull'
-        payload = {"name": model_name, "stream": True}
-        response = requests.post(url, json=payload, stream=True)
-        
-        if response.status_code != 200:
-            st.error(f"Error pulling model: {response.text}")
-            return
+        for node in nodes:
+            target = f" on {node.base_url}" if len(router.nodes) > 1 else ""
+            with node.client.pull(model_name) as response:
+                if response.status_code != 200:
+                    st.error(f"Error pulling model{target}: {response.text}")
+                    return
 
-        total = 0
-        completed = 0
-        for line in response.iter_lines():
-            if line:
-                data = json.loads(line)
-                if "total" in data and "completed" in data:
-                    if total == 0:
-                        total = data['total']
-                    completed = data['completed']
-                    progress = min(1.0, completed / total if total > 0 else 0)
-                    progress_bar.progress(progress, text=f"Downloading {model_name}... {int(progress * 100)}%")
+                total = 0
+                completed = 0
+                for line in response.iter_lines():
+                    if line:
+                        data = json.loads(line)
+                        if "total" in data and "completed" in data:
+                            if total == 0:
+                                total = data['total']
+                            completed = data['completed']
+                            progress = min(1.0, completed / total if total > 0 else 0)
+                            progress_bar.progress(progress, text=f"Downloading {model_name}{target}... {int(progress * 100)}%")
         
         progress_bar.progress(1.0, text=f"{model_name} downloaded successfully!")
+        router.invalidate()
+        # Replies cached for an older build of the model no longer apply
+        model = normalize_model_name(model_name)
+        digest = router.get()['details'].get(model, {}).get('digest')
+        get_response_cache().invalidate(model, digest)
+        get_semantic_cache(st.session_state.embedding_model).invalidate(model, digest)
+        _fetch_model_details.clear()
         time.sleep(2)
         st.rerun()
 
@@ -764,43 +1276,266 @@ def pull_model(model_name, progress_bar):
         st.error(f"Failed to pull model: {e}")
 
 def delete_model(model_name):
-    """Delete a model from Ollama"""
+    """Delete a model from every Ollama node that has it"""
+    router = ollama_router()
     try:
-        url = 'http://localhost:11434/api/delete'
-        payload = {"name": model_name}
-        response = requests.delete(url, json=payload)
+        responses = [node.client.delete(model_name) for node in router.healthy_nodes(model_name)]
+        failed = [response for response in responses if response.status_code != 200]
         
-        if response.status_code == 200:
+        if responses and not failed:
             st.success(f"Model '{model_name}' deleted successfully.")
+            router.invalidate()
+            get_response_cache().invalidate(normalize_model_name(model_name))
+            get_semantic_cache(st.session_state.embedding_model).invalidate(normalize_model_name(model_name))
+            _fetch_model_details.clear()
             time.sleep(2)
             st.rerun()
         else:
-            st.error(f"Failed to delete model: {response.text}")
+            router.invalidate()  # some nodes may have deleted it
+            st.error(f"Failed to delete model: {failed[0].text if failed else 'no reachable node has it'}")
 
     except Exception as e:
         st.error(f"An error occurred: {e}")
 
+@st.cache_data(ttl=300, show_spinner=False)
+def _fetch_model_details(base_url, model):
+    response = get_ollama_client(base_url).show(model)
+    response.raise_for_status()
+    return response.json()
 
-def extract_thinking_tokens(text):
-    """Extract thinking tokens from response (for models like deepseek-r1)"""
-    thinking_pattern = r'<think>(.*?)</think>'
-    thinking_matches = re.findall(thinking_pattern, text, re.DOTALL)
-    
-    # Remove thinking tokens from main response
-    clean_text = re.sub(thinking_pattern, '', text, flags=re.DOTALL).strip()
-    
-    # Also check for other thinking patterns
-    if not thinking_matches:
-        # Check for <thinking> tags
-        thinking_pattern2 = r'<thinking>(.*?)</thinking>'
-        thinking_matches = re.findall(thinking_pattern2, text, re.DOTALL)
-        clean_text = re.sub(thinking_pattern2, '', text, flags=re.DOTALL).strip()
-    
-    return clean_text, ' '.join(thinking_matches) if thinking_matches else None
+def get_model_details(model):
+    """Model metadata from /api/show (capabilities, parameters, model_info), cached for a few minutes"""
+    node = ollama_router().pick(model)
+    if node is None:
+        return {}
+    try:
+        return _fetch_model_details(node.base_url, model)
+    except (requests.exceptions.RequestException, ValueError):
+        return {}
+
+def thinking_option(model):
+    """Value for Ollama's native `think` option: True for models that support it, otherwise left unset"""
+    if st.session_state.native_thinking and 'thinking' in get_model_details(model).get('capabilities', []):
+        return True
+    return None
+
+# Context budget
+MIN_NUM_CTX = 2048
+
+def context_length(model):
+    """Context window the model was trained with, from /api/show's model_info (e.g. llama.context_length)
+
+    None when it is unknown, e.g. because /api/show failed; nothing is trimmed or capped then.
+    """
+    model_info = get_model_details(model).get('model_info') or {}
+    for key, value in model_info.items():
+        if key.endswith('.context_length') and isinstance(value, int) and value > 0:
+            return value
+    return None
+
+def estimate_tokens(text):
+    """Rough token count for text no reply has counted yet"""
+    return max(int(len(text.split()) * 1.3), len(text) // 4)
+
+def in_context(message):
+    """Whether a message of the active branch is sent with the next request (comparison replies are not)"""
+    return message['role'] == 'user' or (message['role'] == 'assistant' and not message.get('model'))
+
+def count_message_tokens(messages, system_prompt):
+    """Prompt size of the active branch as (tokens, exact), filling in Message.tokens from Ollama's counts
+
+    A reply's prompt_eval_count covers the whole prompt it answered, so a user message is counted as what its
+    turn added to the prompt before it, chat template included. A context reply counts its eval_count, unless
+    part of it was thinking that is not sent back. Anything Ollama has not counted yet is estimated.
+    """
+    total = estimate_tokens(system_prompt)
+    exact = True
+    for index, msg in enumerate(messages):
+        if not in_context(msg):
+            continue
+        if msg.tokens is None:
+            if msg['role'] == 'user':
+                counted = 0
+                for reply in messages[index + 1:]:
+                    if reply['role'] == 'user':
+                        break
+                    stats = reply.stats or {}
+                    # A semantic cache hit answered a different prompt
+                    if stats.get('prompt_eval_count') and 'similarity' not in stats:
+                        counted = stats['prompt_eval_count']
+                        break
+                if counted > total:
+                    msg.tokens = counted - total
+            elif msg.stats and msg.stats.get('tokens') and not msg.thinking:
+                msg.tokens = msg.stats['tokens']
+        if msg.tokens is None:
+            exact = False
+        total += estimate_tokens(msg['content']) if msg.tokens is None else msg.tokens
+    return total, exact
+
+def num_ctx_for(model, prompt_tokens):
+    """num_ctx for a request: room for the prompt and a full reply, capped at the model's context length
+
+    Sizes step in powers of two, because Ollama reloads a model whenever num_ctx changes.
+    """
+    num_ctx = MIN_NUM_CTX
+    while num_ctx < prompt_tokens + st.session_state.max_tokens:
+        num_ctx *= 2
+    window = context_length(model)
+    return num_ctx if window is None else min(num_ctx, window)
+
+def build_context(models):
+    """API messages for the active branch, trimmed to the smallest known context window among models
+
+    Returns (api_messages, prompt_tokens, dropped), dropped being how many of the oldest messages were left out.
+    Trimming here keeps whole turns and the system prompt, where Ollama would cut the prompt wherever it overflows.
+    """
+    system_prompt = st.session_state.system_prompt
+    messages = st.session_state.messages
+    prompt_tokens, _ = count_message_tokens(messages, system_prompt)
+    context = [(msg, msg.tokens if msg.tokens is not None else estimate_tokens(msg['content']))
+               for msg in messages if in_context(msg)]
+    windows = [window for window in map(context_length, models) if window is not None]
+    dropped = 0
+    if windows:
+        window = min(windows)
+        # Keep room for the reply, but never more than half the window
+        budget = window - min(st.session_state.max_tokens, window // 2)
+        while len(context) > 1 and (prompt_tokens > budget or context[0][0]['role'] != 'user'):
+            prompt_tokens -= context.pop(0)[1]
+            dropped += 1
+    api_messages = [{"role": "system", "content": system_prompt}]
+    api_messages.extend({"role": msg['role'], "content": msg['content']} for msg, _ in context)
+    return api_messages, prompt_tokens, dropped
+
+def context_caption(models):
+    """Prompt size of the active branch and how much of each model's context window it leaves"""
+    prompt_tokens, exact = count_message_tokens(st.session_state.messages, st.session_state.system_prompt)
+    parts = [f"Prompt: {'' if exact else '~'}{prompt_tokens:,} tokens"]
+    for model in models:
+        window = context_length(model)
+        if window is None:
+            continue
+        if prompt_tokens <= window:
+            parts.append(f"{window - prompt_tokens:,} of {window:,} left" + (f" for {model}" if len(models) > 1 else ""))
+        else:
+            parts.append(f"over {model}'s {window:,}-token window, the oldest messages will be left out")
+    return " · ".join(parts)
+
+# Model preloading and keep-alive
+KEEP_ALIVE_OPTIONS = {
+    "Server default": None,
+    "5 minutes": "5m",
+    "30 minutes": "30m",
+    "1 hour": "1h",
+    "Forever": -1,
+    "Unload after each reply": 0
+}
+
+class ModelWarmer:
+    """Loads models into Ollama's memory in the background so the first message doesn't pay the load time"""
+
+    def __init__(self, client, probe):
+        self.client = client
+        self.probe = probe
+        self.lock = threading.Lock()
+        self.loading = set()
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ollama-warmup")
+
+    def warm(self, model, keep_alive=None, num_ctx=None):
+        """Queue a preload unless one is already in progress for this model"""
+        with self.lock:
+            if model in self.loading:
+                return
+            self.loading.add(model)
+        self.executor.submit(self._load, model, keep_alive, num_ctx)
+
+    def _load(self, model, keep_alive, num_ctx):
+        try:
+            self.client.load(model, keep_alive, num_ctx).close()
+        except requests.exceptions.RequestException:
+            pass  # a failed warm-up only means the first message pays the load time
+        finally:
+            with self.lock:
+                self.loading.discard(model)
+            self.probe.refresh()  # so the sidebar and routing see the model as loaded
+
+    def in_progress(self):
+        with self.lock:
+            return set(self.loading)
+
+@st.cache_resource(show_spinner=False)
+def get_model_warmer(base_url):
+    """One warmer per Ollama base URL"""
+    return ModelWarmer(get_ollama_client(base_url), get_ollama_probe(base_url))
+
+def get_loaded_models():
+    """Models currently held in memory on each Ollama node, as of its last health probe"""
+    return [dict(model, node=node.base_url) for node, result in ollama_router().node_results()
+            for model in result['loaded_details']]
+
+def models_loading():
+    """Models being preloaded on any node of this session's pool"""
+    return set().union(*(get_model_warmer(node.base_url).in_progress() for node in ollama_router().nodes))
+
+def keep_alive_for(model):
+    """The keep_alive value to send with every request for this model"""
+    return KEEP_ALIVE_OPTIONS.get(st.session_state.keep_alive.get(model, "Server default"))
 
-def stream_ollama_response(model, messages, temperature, top_p, max_tokens):
-    """Stream response from Ollama API"""
-    url = 'http://localhost:11434/api/chat'
+def preload_new_selections():
+    """Warm up models that were just selected and are not already loaded"""
+    selected = set(m for m in st.session_state.selected_models if m)
+    newly_selected = selected - st.session_state.get('preloaded_selection', set())
+    st.session_state.preloaded_selection = selected
+    if not st.session_state.preload_models or not newly_selected:
+        return
+    loaded = {m['name'] for m in get_loaded_models()}
+    router = ollama_router()
+    prompt_tokens, _ = count_message_tokens(st.session_state.messages, st.session_state.system_prompt)
+    for model in newly_selected - loaded:
+        if keep_alive_for(model) == 0:
+            continue  # it would be unloaded again as soon as it finished loading
+        # Warm the node the model's requests will be routed to, with the num_ctx they will ask for
+        node = router.pick(model)
+        if node is not None:
+            get_model_warmer(node.base_url).warm(model, keep_alive_for(model), num_ctx_for(model, prompt_tokens))
+
+def build_response_stats(final, chunks, ttft, latency, done_reason=None):
+    """Per-response metrics record from Ollama's final-chunk statistics plus client-side timings (seconds)"""
+    eval_count = final.get('eval_count', chunks)
+    eval_duration = final.get('eval_duration', 0) / 1e9
+    prompt_eval_count = final.get('prompt_eval_count', 0)
+    prompt_eval_duration = final.get('prompt_eval_duration', 0) / 1e9
+    if eval_duration > 0:
+        tokens_per_sec = eval_count / eval_duration
+    elif ttft is not None and latency > ttft:
+        # No server timings (e.g. a stopped stream): estimate decode rate from wall-clock time
+        tokens_per_sec = eval_count / (latency - ttft)
+    else:
+        tokens_per_sec = 0
+    return {
+        'tokens': eval_count,
+        'tokens_per_sec': tokens_per_sec,
+        'ttft': ttft,
+        'load_duration': final.get('load_duration', 0) / 1e9,
+        'prompt_eval_count': prompt_eval_count,
+        'prompt_eval_duration': prompt_eval_duration,
+        'prompt_tokens_per_sec': prompt_eval_count / prompt_eval_duration if prompt_eval_duration > 0 else 0,
+        'eval_duration': eval_duration,
+        'total_duration': final.get('total_duration', 0) / 1e9,
+        'latency': latency,
+        'done_reason': done_reason or final.get('done_reason')
+    }
+
+def stream_ollama_response(model, messages, temperature, top_p, max_tokens, router=None, think=None,
+                           cancel_event=None, keep_alive=None, node=None, num_ctx=None, on_connection=None):
+    """Stream response from Ollama API, yielding (content, thinking, chunks, elapsed) and finally (None, None, tokens, stats)
+
+    The request goes to node, or else the node the router picks. If that node fails before the first chunk, the
+    request is retried on the next best node, so the caller only sees an error once every node failed.
+    on_connection is called with the connection in use, and with None before it goes back to the pool.
+    """
+    router = router or ollama_router()
     
     payload = {
         'model': model,
@@ -812,32 +1547,1029 @@ def stream_ollama_response(model, messages, temperature, top_p, max_tokens):
             'num_predict': max_tokens
         }
     }
+    if num_ctx is not None:
+        payload['options']['num_ctx'] = num_ctx
+    if think is not None:
+        payload['think'] = think
+    if keep_alive is not None:
+        payload['keep_alive'] = keep_alive
     
+    chunks = 0
+    ttft = None
+    start_time = time.time()
+    tried = []
+    last_error = "No Ollama node is available"
+    while True:
+        if node is None or node in tried:
+            node = router.pick(model, exclude=tried)
+        if node is None:
+            yield f"Error: {last_error}", None, 0, 0
+            return
+        tried.append(node)
+        try:
+            # Closing the response returns its connection to the pool (or drops it if abandoned mid-stream)
+            with node.track() as client, client.chat(payload, on_connection) as response:
+                try:
+                    if response.status_code != 200:
+                        last_error = f"HTTP {response.status_code}: {response.text.strip()}"
+                        # An error status is about this request (say the model failed to load), not the node
+                        # being down, so it is only retried elsewhere; other sessions keep using the node
+                        continue
+                    for line in response.iter_lines():
+                        if cancel_event is not None and cancel_event.is_set():
+                            # Leaving the with-block closes the connection, which makes Ollama stop decoding
+                            stats = build_response_stats({}, chunks, ttft, time.time() - start_time, 'cancelled')
+                            yield None, None, stats['tokens'], stats
+                            break
+                        if line:
+                            json_response = json.loads(line)
+                            if 'message' in json_response:
+                                content = json_response['message'].get('content', '')
+                                thinking = json_response['message'].get('thinking', '')
+                                elapsed = time.time() - start_time
+                                if ttft is None and (content or thinking):
+                                    ttft = elapsed
+                                chunks += 1
+                                yield content, thinking, chunks, elapsed
+                                
+                            if json_response.get('done', False):
+                                # Get final statistics
+                                stats = build_response_stats(json_response, chunks, ttft, time.time() - start_time)
+                                if len(router.nodes) > 1:
+                                    stats['node'] = node.base_url
+                                yield None, None, stats['tokens'], stats
+                finally:
+                    if on_connection is not None:
+                        on_connection(None)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            if cancel_event is not None and cancel_event.is_set():
+                # Stop shut the connection down while it was waiting on Ollama
+                stats = build_response_stats({}, chunks, ttft, time.time() - start_time, 'cancelled')
+                yield None, None, stats['tokens'], stats
+                return
+            if chunks:
+                yield f"Error: {str(e)}", None, 0, 0
+                return
+            # Nothing was streamed yet, so the request can move to another node unnoticed
+            last_error = str(e)
+            router.mark_down(node, f"Error: {last_error}")
+            continue
+        except Exception as e:
+            if cancel_event is None or not cancel_event.is_set():
+                yield f"Error: {str(e)}", None, 0, 0
+        return
+
+# Delta-append streaming output
+class DeltaMarkdownStream:
+    """Drop-in for st.empty() while streaming: finished markdown blocks are sent once, only the open tail is redrawn"""
+
+    def __init__(self, placeholder):
+        self.placeholder = placeholder
+        self._reset()
+
+    def _reset(self):
+        self.container = self.placeholder.container()
+        self.tail = self.container.empty()
+        self.committed = ""     # text already sent as finished blocks
+        self.scan_pos = 0       # start of the first line not yet scanned for block boundaries
+        self.block_start = 0
+        self.in_fence = False
+
+    def _commit(self, text, end):
+        """Freeze text[block_start:end] in the current tail element and open a new tail after it"""
+        block = text[self.block_start:end]
+        if block.strip():
+            self.tail.markdown(block)
+            self.tail = self.container.empty()
+            self.committed = text[:end]
+            self.block_start = end
+
+    def markdown(self, text):
+        """Render the full text so far, sending only what changed since the last call"""
+        if not text.startswith(self.committed):
+            # The text was rewritten rather than appended to; start over
+            self._reset()
+
+        # Blank lines outside fenced code end a block; only complete lines are considered
+        while True:
+            line_end = text.find('\n', self.scan_pos)
+            if line_end == -1:
+                break
+            line = text[self.scan_pos:line_end].strip()
+            self.scan_pos = line_end + 1
+            if line.startswith('```') or line.startswith('~~~'):
+                self.in_fence = not self.in_fence
+            elif not line and not self.in_fence:
+                self._commit(text, self.scan_pos)
+
+        self.tail.markdown(text[self.block_start:])
+
+# Streaming render scheduler
+class StreamRenderer:
+    """Coalesce streamed chunks into at most one placeholder update per frame interval"""
+
+    def __init__(self, placeholder, interval_ms=DEFAULT_RENDER_INTERVAL_MS, max_pending_chars=RENDER_MAX_PENDING_CHARS,
+                 delta=True):
+        self.placeholder = placeholder
+        self.output = DeltaMarkdownStream(placeholder) if delta else placeholder
+        self.interval = max(0, interval_ms) / 1000
+        self.max_pending_chars = max_pending_chars
+        self.last_render = 0.0
+        self.rendered_chars = 0
+
+    def update(self, text):
+        """Render the in-progress text if the frame interval has passed or enough text is pending"""
+        now = time.monotonic()
+        if now - self.last_render >= self.interval or len(text) - self.rendered_chars >= self.max_pending_chars:
+            self.output.markdown(text + "▌")
+            self.last_render = now
+            self.rendered_chars = len(text)
+
+    def flush(self, text):
+        """Render the final text exactly, as a single markdown element without the cursor"""
+        self.placeholder.markdown(text)
+        self.rendered_chars = len(text)
+
+# Live response view
+class ResponseStreamView:
+    """One model's response while it streams: reasoning live in its own expander, answer below it"""
+
+    def __init__(self, model=None):
+        self.model = model
+        self.parser = ThinkingStreamParser()
+        self.stats = {}
+        self.container = st.container()
+        with self.container:
+            self.thinking_slot = st.empty()
+            self.answer_renderer = self._renderer(st.empty())
+        self.thinking_renderer = None
+        self.consumed = 0
+        self.final = None
+
+    def _renderer(self, placeholder):
+        return StreamRenderer(placeholder, st.session_state.render_interval_ms,
+                              delta=st.session_state.delta_streaming)
+
+    def feed(self, chunk, thinking=None):
+        """Route one streamed chunk to the thinking and answer displays"""
+        answer_delta, thinking_delta = self.parser.feed(chunk, thinking)
+        if thinking_delta:
+            if self.thinking_renderer is None:
+                expander = self.thinking_slot.expander("🤔 Thinking...", expanded=True)
+                self.thinking_renderer = self._renderer(expander.empty())
+            self.thinking_renderer.update(self.parser.thinking)
+        if answer_delta:
+            self.answer_renderer.update(self.parser.answer.lstrip())
+
+    def pump(self, job):
+        """Feed the chunks a background job has produced since the last call"""
+        events = job.events
+        end = len(events)
+        for chunk, thinking in events[self.consumed:end]:
+            self.feed(chunk, thinking)
+        self.consumed = end
+
+    def finish(self, stopped=False):
+        """Build the assistant message to store (no rendering, so it cannot be interrupted half-way)"""
+        clean_content, thinking = self.parser.finish()
+        message = Message("assistant", clean_content, model=self.model or None, thinking=thinking,
+                          stats=self.stats, stopped=stopped, has_response_data=True)
+        self.final = message
+        return message
+
+    def flush(self):
+        """Render the finished response exactly"""
+        response_data = self.final['response_data']
+        with self.container:
+            self.answer_renderer.flush(response_data['clean_content'])
+            
+            # Display stats
+            caption = stats_caption(response_data)
+            if caption:
+                st.caption(caption)
+            
+            # Collapse the live reasoning into the usual thinking expander
+            if response_data['thinking']:
+                with self.thinking_slot.expander("🤔 Thinking Process", expanded=False):
+                    st.markdown(f"```\n{response_data['thinking']}\n```")
+            else:
+                self.thinking_slot.empty()
+
+def stats_caption(response_data):
+    """One-line caption summarising a response's statistics"""
+    stats = response_data.get('stats') or {}
+    parts = []
+    if stats:
+        parts.append(f"📊 {stats.get('tokens', 0)} tokens | {stats.get('tokens_per_sec', 0):.1f} tok/s")
+    # Older messages only recorded tokens and tok/s
+    if stats.get('ttft') is not None:
+        parts.append(f"TTFT {stats['ttft']:.2f}s")
+    if stats.get('load_duration'):
+        parts.append(f"load {stats['load_duration']:.2f}s")
+    if stats.get('prompt_eval_count'):
+        parts.append(f"prompt {stats['prompt_eval_count']} tok @ {stats.get('prompt_tokens_per_sec', 0):.0f} tok/s")
+    if stats.get('latency'):
+        parts.append(f"{stats['latency']:.2f}s total")
+    if stats.get('node'):
+        parts.append(f"on {stats['node']}")
+    if stats.get('similarity'):
+        parts.append(f"⚡ cached answer to a similar question ({stats['similarity']:.0%} match)")
+    elif stats.get('cached'):
+        parts.append("⚡ cached")
+    if response_data.get('stopped'):
+        parts.append("⏹ stopped early")
+    return " | ".join(parts)
+
+# Response cache
+RESPONSE_CACHE_PATH = os.path.join(CACHE_DIR, 'responses.db')
+RESPONSE_CACHE_BYTES = int(os.environ.get('OLLAMA_CHAT_RESPONSE_CACHE_MB', '256')) * 1024 * 1024
+
+def normalize_model_name(model):
+    """Name as /api/tags lists it: an untagged name means the latest tag"""
+    return model if ':' in model else f"{model}:latest"
+
+def response_cache_key(model, digest, messages, options, think=None):
+    """Key of a deterministic request: the exact model build, the full messages and every option shaping the output"""
+    request = {'model': model, 'digest': digest, 'messages': messages, 'options': options, 'think': think}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """SQLite store of finished replies to deterministic requests, evicted least recently used past a byte budget
+
+    A reply is kept as the chunks it streamed in, so a hit replays through the same path as a live response.
+    """
+
+    def __init__(self, path, max_bytes=RESPONSE_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cached_responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    accessed REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    data BLOB NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cached_responses_accessed ON cached_responses (accessed)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cached_responses_model ON cached_responses (model)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get(self, key):
+        """(events, stats) stored under key, or None; a hit counts as a use for eviction"""
+        with self.lock, self._connect() as conn:
+            row = conn.execute("SELECT data FROM cached_responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE cached_responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        data = json.loads(decompress_blob(row[0]))
+        return [tuple(event) for event in data['events']], data['stats']
+
+    def put(self, key, model, digest, events, stats):
+        data = compress_blob(json.dumps({'events': events, 'stats': stats}, separators=(',', ':')).encode('utf-8'))
+        if len(data) > self.max_bytes:
+            return
+        with self.lock, self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO cached_responses VALUES (?, ?, ?, ?, ?, ?)",
+                         (key, model, digest, time.time(), len(data), data))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cached_responses").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            evicted = []
+            for old_key, size in conn.execute("SELECT key, size FROM cached_responses ORDER BY accessed"):
+                if total <= self.max_bytes:
+                    break
+                evicted.append((old_key,))
+                total -= size
+            conn.executemany("DELETE FROM cached_responses WHERE key = ?", evicted)
+
+    def invalidate(self, model, keep_digest=None):
+        """Drop a model's replies, except those produced by keep_digest (its current build)"""
+        with self.lock, self._connect() as conn:
+            conn.execute("DELETE FROM cached_responses WHERE model = ? AND digest != ?", (model, keep_digest or ''))
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    """Process-wide response cache"""
+    return ResponseCache(RESPONSE_CACHE_PATH)
+
+def cached_response_key(model, digest, api_messages):
+    """Cache key for this session's next request to model, or None when the reply should not be cached
+
+    Only opted-in, temperature 0 requests to a model whose digest is known are cached.
+    """
+    if not st.session_state.response_cache or st.session_state.temperature != 0 or not digest:
+        return None
+    options = {'temperature': 0, 'top_p': st.session_state.top_p, 'num_predict': st.session_state.max_tokens}
+    return response_cache_key(model, digest, api_messages, options, thinking_option(model))
+
+def replay_cached_response(events, stats):
+    """Yield a cached reply in the same (content, thinking, chunks, elapsed) form stream_ollama_response does"""
+    for chunks, (content, thinking) in enumerate(events, 1):
+        yield content, thinking, chunks, 0.0
+    stats = dict(stats, cached=True)
+    yield None, None, stats['tokens'], stats
+
+# Semantic response cache
+SEMANTIC_CACHE_DIR = os.path.join(CACHE_DIR, 'semantic')
+SEMANTIC_SEARCH_BATCH = 65536  # vectors compared per matrix product, bounding the memory a lookup touches
+
+class SemanticCache:
+    """Replies found again by prompt similarity rather than exact match, for one embedding model
+
+    Prompt embeddings are stored unit-length in a memory-mapped float32 file, row n belonging to the
+    reply stored as row n in SQLite. Rows are grouped by context (session, model build, system prompt and
+    the turns before the question), so a lookup is a cosine-similarity product over that group's rows.
+    Every process serving the app appends to the same file: a row number is the file's length at the
+    time of writing, taken under a file lock, and rows other processes added are picked up on lookup.
+    """
+
+    def __init__(self, embed_model, directory=SEMANTIC_CACHE_DIR):
+        self.embed_model = embed_model
+        os.makedirs(directory, exist_ok=True)
+        name = hashlib.sha256(embed_model.encode('utf-8')).hexdigest()[:16]
+        self.vectors_path = os.path.join(directory, f"{name}.f32")
+        self.lock_path = os.path.join(directory, f"{name}.lock")
+        self.db_path = os.path.join(directory, 'semantic.db')
+        self.lock = threading.Lock()
+        self.dim = None
+        self.count = 0          # rows of the vector file this process has mapped and grouped
+        self.vectors = None     # read-only memmap over those rows
+        self.partitions = {}    # context key -> row numbers
+        self.metrics = {'build_seconds': 0.0, 'lookups': 0, 'hits': 0, 'search_seconds': 0.0,
+                        'embeddings': 0, 'embed_seconds': 0.0, 'errors': 0}
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS semantic_responses (
+                    embed_model TEXT NOT NULL,
+                    row INTEGER NOT NULL,
+                    partition TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    dim INTEGER NOT NULL,
+                    prompt TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (embed_model, row)
+                )
+            """)
+        self._build()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _build(self):
+        """Map the vector file and group its rows by context"""
+        start = time.perf_counter()
+        with file_lock(self.lock_path), self._connect() as conn:
+            rows = conn.execute("SELECT row, partition, dim FROM semantic_responses WHERE embed_model = ?",
+                                (self.embed_model,)).fetchall()
+            if rows and os.path.exists(self.vectors_path):
+                self.dim = rows[0][2]
+                self.count = os.path.getsize(self.vectors_path) // (4 * self.dim)
+                # Drop a partial row left by a crash, so appends stay aligned
+                with open(self.vectors_path, 'r+b') as f:
+                    f.truncate(self.count * 4 * self.dim)
+                for row, partition, _ in rows:
+                    if row < self.count:
+                        self.partitions.setdefault(partition, []).append(row)
+            elif os.path.exists(self.vectors_path):
+                os.remove(self.vectors_path)  # vectors without replies
+        self._map()
+        self.metrics['build_seconds'] = time.perf_counter() - start
+
+    def _map(self):
+        self.vectors = (np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self.count, self.dim))
+                        if self.count else None)
+
+    def _refresh(self):
+        """Map and group the rows other processes appended since the last look (caller holds self.lock)"""
+        if self.dim is None:
+            with self._connect() as conn:
+                row = conn.execute("SELECT dim FROM semantic_responses WHERE embed_model = ? LIMIT 1",
+                                   (self.embed_model,)).fetchone()
+            if row is None:
+                return
+            self.dim = row[0]
+        try:
+            size = os.path.getsize(self.vectors_path)
+        except FileNotFoundError:
+            return
+        if size < (self.count + 1) * 4 * self.dim:
+            return
+        # Writers append the vector and insert its reply under the file lock, so both are visible here
+        with file_lock(self.lock_path), self._connect() as conn:
+            count = os.path.getsize(self.vectors_path) // (4 * self.dim)
+            rows = conn.execute("SELECT row, partition FROM semantic_responses "
+                                "WHERE embed_model = ? AND row >= ? AND row < ? ORDER BY row",
+                                (self.embed_model, self.count, count)).fetchall()
+        for row, partition in rows:
+            self.partitions.setdefault(partition, []).append(row)
+        self.count = count
+        self._map()
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, partition, vector, threshold):
+        """(similarity, events, stats) of the closest cached prompt in partition at or above threshold, else None"""
+        start = time.perf_counter()
+        query = self._unit(vector)
+        best_row, best = None, -1.0
+        with self.lock:
+            self._refresh()
+            rows = self.partitions.get(partition)
+            if rows and self.vectors is not None and query.shape == (self.dim,):
+                for offset in range(0, len(rows), SEMANTIC_SEARCH_BATCH):
+                    batch = np.asarray(rows[offset:offset + SEMANTIC_SEARCH_BATCH])
+                    similarities = self.vectors[batch] @ query
+                    index = int(np.argmax(similarities))
+                    if similarities[index] > best:
+                        best, best_row = float(similarities[index]), int(batch[index])
+            self.metrics['lookups'] += 1
+            self.metrics['search_seconds'] += time.perf_counter() - start
+        if best_row is None or best < threshold:
+            return None
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM semantic_responses WHERE embed_model = ? AND row = ?",
+                               (self.embed_model, best_row)).fetchone()
+        if row is None:
+            return None
+        data = json.loads(decompress_blob(row[0]))
+        with self.lock:
+            self.metrics['hits'] += 1
+        return best, [tuple(event) for event in data['events']], data['stats']
+
+    def put(self, partition, model, digest, prompt, vector, events, stats):
+        """Store a finished reply under its prompt's embedding"""
+        vector = self._unit(vector)
+        data = compress_blob(json.dumps({'events': events, 'stats': stats}, separators=(',', ':')).encode('utf-8'))
+        with self.lock:
+            self._refresh()
+            if self.dim is None:
+                self.dim = len(vector)
+            if vector.shape != (self.dim,):
+                return
+            row_bytes = 4 * self.dim
+            with file_lock(self.lock_path):
+                with open(self.vectors_path, 'ab') as f:
+                    # The row number is where the file ends now, whichever processes wrote the rows before it
+                    row = f.seek(0, os.SEEK_END) // row_bytes
+                    f.truncate(row * row_bytes)  # drop a partial row left by a crash
+                    f.write(vector.tobytes())
+                with self._connect() as conn:
+                    conn.execute("INSERT OR REPLACE INTO semantic_responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 (self.embed_model, row, partition, model, digest, self.dim, prompt, time.time(), data))
+            self._refresh()  # maps the new row, and any another process added first
+
+    def invalidate(self, model, keep_digest=None):
+        """Forget a model's replies except keep_digest's; their vector rows stay in the file but are never searched again"""
+        with self.lock, self._connect() as conn:
+            where = "embed_model = ? AND model = ? AND digest != ?"
+            params = (self.embed_model, model, keep_digest or '')
+            rows = conn.execute(f"SELECT row FROM semantic_responses WHERE {where}", params).fetchall()
+            conn.execute(f"DELETE FROM semantic_responses WHERE {where}", params)
+            dropped = {row[0] for row in rows}
+            self.partitions = {partition: [row for row in rows if row not in dropped]
+                               for partition, rows in self.partitions.items()}
+
+    def record_embedding(self, seconds=None):
+        """Count one prompt embedding, or a failed one when seconds is None"""
+        with self.lock:
+            if seconds is None:
+                self.metrics['errors'] += 1
+            else:
+                self.metrics['embeddings'] += 1
+                self.metrics['embed_seconds'] += seconds
+
+    def summary(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+            metrics['entries'] = sum(len(rows) for rows in self.partitions.values())
+        return metrics
+
+@st.cache_resource(show_spinner=False)
+def get_semantic_cache(embed_model):
+    """Process-wide semantic cache per embedding model"""
+    return SemanticCache(embed_model)
+
+def semantic_cache_query(api_messages):
+    """(cache, prompt, embedding) for the question that ends api_messages, or None if the semantic cache is off or embedding failed"""
+    if not st.session_state.semantic_cache or api_messages[-1]['role'] != 'user':
+        return None
+    cache = get_semantic_cache(st.session_state.embedding_model)
+    prompt = api_messages[-1]['content']
+    node = ollama_router().pick(cache.embed_model)
+    if node is None:
+        cache.record_embedding(None)
+        return None
+    start = time.perf_counter()
     try:
-        response = requests.post(url, json=payload, stream=True)
-        
-        full_response = ""
-        tokens = 0
-        start_time = time.time()
-        
-        for line in response.iter_lines():
-            if line:
-                json_response = json.loads(line)
-                if 'message' in json_response:
-                    content = json_response['message'].get('content', '')
-                    full_response += content
-                    tokens += 1
-                    yield content, tokens, time.time() - start_time
-                    
-                if json_response.get('done', False):
-                    # Get final statistics
-                    eval_count = json_response.get('eval_count', tokens)
-                    eval_duration = json_response.get('eval_duration', 0) / 1e9  # Convert to seconds
-                    tokens_per_sec = eval_count / eval_duration if eval_duration > 0 else 0
-                    yield None, eval_count, tokens_per_sec
-                    
-    except Exception as e:
-        yield f"Error: {str(e)}", 0, 0
+        response = node.client.embed(cache.embed_model, prompt)
+        response.raise_for_status()
+        embedding = response.json()['embeddings'][0]
+    except (requests.exceptions.RequestException, ValueError, KeyError, IndexError):
+        cache.record_embedding(None)
+        return None
+    cache.record_embedding(time.perf_counter() - start)
+    return cache, prompt, embedding
+
+def semantic_partition(model, digest, api_messages):
+    """Context a semantic match must share: this session, the model build and every message before the question"""
+    # Unlike an exact hit, a similar question could surface a reply meant for someone else's, so matches stay per session
+    session = hashlib.sha256(session_key().encode('utf-8')).hexdigest()[:16]
+    return f"{session}:{response_cache_key(model, digest, api_messages[:-1], None)}"
+
+# Background generation jobs
+GENERATION_WORKERS = 32
+MODEL_SLOTS_PER_NODE = int(os.environ.get('OLLAMA_NUM_PARALLEL') or 4)  # requests one node serves per model at once
+NODE_SLOTS = MODEL_SLOTS_PER_NODE * int(os.environ.get('OLLAMA_MAX_LOADED_MODELS') or 3)  # and in total
+GENERATION_POLL_INTERVAL = 0.02
+
+@st.cache_resource(show_spinner=False)
+def get_generation_executor():
+    """Process-wide worker pool that runs generations independently of Streamlit reruns"""
+    return ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix="ollama-generate")
+
+class GenerationJob:
+    """One model's streamed generation, run on a worker thread and cancellable from any rerun"""
+
+    def __init__(self, model, messages, temperature, top_p, max_tokens, router, think=None, keep_alive=None,
+                 session=None, max_parallel=1, cached=None, cache_writers=(), num_ctx=None, metrics_store=None):
+        self.model = model
+        self.messages = messages
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_tokens = max_tokens
+        self.router = router
+        self.think = think
+        self.keep_alive = keep_alive
+        self.num_ctx = num_ctx
+        self.session = session              # scheduler queue the job waits in
+        self.max_parallel = max_parallel    # how many of the session's jobs may stream at once
+        self.scheduler = None
+        self.started = threading.Event()    # set once the scheduler let the job run
+        self.cached = cached                # (events, stats) of a cache hit to replay instead of generating
+        self.cache_writers = cache_writers  # callables storing a finished reply as (events, stats)
+        self.metrics_store = metrics_store  # where a completed live reply's statistics go
+        self.metrics_error = None           # failure to record them, shown by the session that started the job
+        self.events = []        # (chunk, thinking) pairs, appended by the worker and read by the script thread
+        self.stats = {}
+        self.stopped = False
+        self.cancel_event = threading.Event()
+        self.done = threading.Event()
+        self.connection = None  # connection of the request in flight
+        self.connection_lock = threading.Lock()
+
+    def cancel(self):
+        """Abort the job: its connection is shut down even before the first chunk, a queued job is dropped"""
+        self.cancel_event.set()
+        if self.scheduler is not None:
+            self.scheduler.withdraw(self)
+        with self.connection_lock:
+            if self.connection is not None:
+                abort_connection(self.connection)
+
+    def _watch_connection(self, conn):
+        # The lock keeps cancel() from shutting down a connection already returned to the pool
+        with self.connection_lock:
+            self.connection = conn
+            if conn is not None and self.cancel_event.is_set():
+                abort_connection(conn)
+
+    def run(self, node=None):
+        """Stream the reply, starting on node when the scheduler reserved one"""
+        try:
+            if self.cancel_event.is_set():
+                return
+            if self.cached is not None:
+                stream = replay_cached_response(*self.cached)
+            else:
+                stream = stream_ollama_response(
+                    self.model, self.messages, self.temperature, self.top_p, self.max_tokens,
+                    router=self.router, think=self.think, cancel_event=self.cancel_event, keep_alive=self.keep_alive,
+                    node=node, num_ctx=self.num_ctx, on_connection=self._watch_connection
+                )
+            for chunk, thinking, tokens, elapsed_or_stats in stream:
+                if chunk is not None:
+                    self.events.append((chunk, thinking))
+                else:
+                    self.stats = elapsed_or_stats
+            if self.cached is None and self.stats and not self.cancel_event.is_set():
+                # Recorded here, so the dashboard gets it even if no rerun of the session ever renders the reply
+                self._record_metrics()
+                for write in self.cache_writers:
+                    try:
+                        write(self.events, self.stats)
+                    except (sqlite3.Error, OSError):
+                        pass  # the reply is still shown; it just isn't cached
+        finally:
+            self.stopped = self.cancel_event.is_set() and self.stats.get('done_reason', 'cancelled') == 'cancelled'
+            self.done.set()
+
+    def _record_metrics(self):
+        """Persist the statistics of a completed reply together with the parameters it ran with"""
+        if self.metrics_store is None:
+            return
+        try:
+            self.metrics_store.record(self.model, self.stats, self.temperature, self.top_p, self.max_tokens)
+        except sqlite3.Error as e:
+            self.metrics_error = e
+
+@st.cache_resource(show_spinner=False)
+def get_generation_scheduler():
+    """Process-wide scheduler shared by every session"""
+    return GenerationScheduler(get_generation_executor(), MODEL_SLOTS_PER_NODE, NODE_SLOTS)
+
+def start_generation(models, api_messages, comparison, turn_id, use_cache=True, prompt_tokens=None):
+    """Queue one background job per model and remember them in the session; replies go to turn_id
+
+    With use_cache, a model's reply may be replayed from the exact or the semantic response cache. Given
+    prompt_tokens, each request's num_ctx is sized to it.
+    """
+    router = ollama_router()
+    scheduler = get_generation_scheduler()
+    jobs = []
+    cache = get_response_cache()
+    # The question is embedded once for all models
+    semantic = semantic_cache_query(api_messages)
+    for model in models:
+        digest = router.get()['details'].get(model, {}).get('digest')
+        cached = None
+        cache_writers = []
+        cache_key = cached_response_key(model, digest, api_messages)
+        if cache_key:
+            try:
+                cached = cache.get(cache_key) if use_cache else None
+            except sqlite3.Error:
+                pass
+            cache_writers.append(partial(cache.put, cache_key, model, digest))
+        if semantic and digest:
+            semantic_cache, prompt, embedding = semantic
+            partition = semantic_partition(model, digest, api_messages)
+            if cached is None and use_cache:
+                try:
+                    hit = semantic_cache.lookup(partition, embedding, st.session_state.semantic_threshold)
+                except sqlite3.Error:
+                    hit = None
+                if hit:
+                    similarity, events, stats = hit
+                    cached = (events, dict(stats, similarity=similarity))
+            cache_writers.append(partial(semantic_cache.put, partition, model, digest, prompt, embedding))
+        job = GenerationJob(
+            model, api_messages,
+            st.session_state.temperature,
+            st.session_state.top_p,
+            st.session_state.max_tokens,
+            router=router, think=thinking_option(model), keep_alive=keep_alive_for(model),
+            session=session_key(), max_parallel=max(1, int(st.session_state.max_parallel_streams)),
+            cached=cached, cache_writers=cache_writers,
+            num_ctx=num_ctx_for(model, prompt_tokens) if prompt_tokens is not None else None,
+            metrics_store=get_metrics_store()
+        )
+        if cached is not None:
+            # A replay needs no Ollama slot
+            job.started.set()
+            get_generation_executor().submit(job.run)
+        else:
+            scheduler.submit(job)
+        jobs.append(job)
+    st.session_state.active_generation = {
+        'jobs': jobs, 'comparison': comparison, 'started': time.time(), 'turn': turn_id,
+        'tree': st.session_state.tree.tree_id
+    }
+
+def generate_replies(use_cache=True):
+    """Send the active branch to the selected models; their replies are added to its last turn"""
+    comparison = st.session_state.comparison_mode and len(st.session_state.selected_models) > 1
+    models = st.session_state.selected_models if comparison else st.session_state.selected_models[:1]
+    api_messages, prompt_tokens, dropped = build_context(models)
+    if dropped:
+        st.toast(f"Left out the {dropped} oldest messages to fit the context window")
+    start_generation(models, api_messages, comparison, st.session_state.tree.leaf, use_cache, prompt_tokens)
+
+def switch_branch(turn_id):
+    st.session_state.tree.switch_to(turn_id)
+    refresh_messages()
+
+def fork_at(turn_id):
+    """Cut the active branch back to turn_id, so the next message starts a new branch there"""
+    st.session_state.tree.set_leaf(turn_id)
+    refresh_messages()
+
+def render_branch_controls(turn):
+    """◀ n/m ▶ switcher for turns with alternatives, and a fork button for turns before the leaf"""
+    tree = st.session_state.tree
+    siblings = tree.siblings(turn.id)
+    busy = bool(st.session_state.get('active_generation'))
+    forkable = turn.id != tree.leaf and len(turn.messages) > 1
+    if len(siblings) < 2 and not forkable:
+        return
+    col1, col2, col3, col4 = st.columns([1, 2, 1, 2])
+    if len(siblings) > 1:
+        position = siblings.index(turn.id)
+        with col1:
+            st.button("◀", key=f"branch_prev_{turn.id}", disabled=busy or position == 0,
+                      on_click=switch_branch, args=(siblings[max(position - 1, 0)],))
+        with col2:
+            st.caption(f"Branch {position + 1}/{len(siblings)}")
+        with col3:
+            st.button("▶", key=f"branch_next_{turn.id}", disabled=busy or position == len(siblings) - 1,
+                      on_click=switch_branch, args=(siblings[min(position + 1, len(siblings) - 1)],))
+    if forkable:
+        with col4:
+            st.button("🔀 Fork here", key=f"fork_{turn.id}", disabled=busy, on_click=fork_at, args=(turn.id,),
+                      help="Continue from this reply in a new branch; the later messages stay in theirs")
+
+def cancel_generation(model=None):
+    """Stop the active generation for one model, or for all of them"""
+    generation = st.session_state.get('active_generation')
+    if generation:
+        for job in generation['jobs']:
+            if model is None or job.model == model:
+                job.cancel()
+
+def generation_status(jobs, started):
+    """Status line for a running generation: elapsed time, or queue positions while waiting for a slot"""
+    scheduler = get_generation_scheduler()
+    waiting = []
+    for job in jobs:
+        status = scheduler.queue_status(job) if not job.started.is_set() else None
+        if status:
+            position, eta = status
+            wait = f", about {int(eta) + 1}s" if eta is not None else ""
+            waiting.append((f"{job.model} " if len(jobs) > 1 else "") + f"#{position} in line{wait}")
+    if waiting:
+        return "⏳ Waiting for a free slot: " + " · ".join(waiting)
+    return f"⏳ Generating... {int(time.time() - started)}s"
+
+def render_active_generation():
+    """Stream the session's running jobs into the page, then store their responses once all have finished"""
+    generation = st.session_state.active_generation
+    jobs = generation['jobs']
+    views = []
+    
+    if generation['comparison']:
+        st.button("⏹ Stop all", key="stop_generation", on_click=cancel_generation)
+        response_cols = st.columns(len(jobs))
+        for col, job in zip(response_cols, jobs):
+            with col:
+                st.markdown(f"**{job.model}:**")
+                st.button("⏹ Stop", key=f"stop_generation_{job.model}", on_click=cancel_generation, args=(job.model,))
+                views.append(ResponseStreamView(job.model))
+    else:
+        with st.chat_message("assistant"):
+            st.button("⏹ Stop", key="stop_generation", on_click=cancel_generation)
+            views.append(ResponseStreamView())
+    
+    # Any Streamlit call lets a Stop click interrupt this run, so keep a ticking status
+    # while waiting for chunks; the jobs themselves keep running across reruns
+    status = st.empty()
+    status_text = None
+    while True:
+        finished = all(job.done.is_set() for job in jobs)
+        for job, view in zip(jobs, views):
+            view.pump(job)
+        if finished:
+            break
+        text = generation_status(jobs, generation['started'])
+        if text != status_text:
+            status.caption(text)
+            status_text = text
+        time.sleep(GENERATION_POLL_INTERVAL)
+    
+    if generation['tree'] != st.session_state.tree.tree_id:
+        # The conversation was replaced meanwhile, so the replies have no turn to go to
+        st.session_state.active_generation = None
+        status.empty()
+        return
+    
+    # Commit every response before rendering anything, so an interrupted run cannot store half of them
+    for job, view in zip(jobs, views):
+        view.stats = job.stats
+    for job, view in zip(jobs, views):
+        st.session_state.tree.add_reply(generation['turn'], view.finish(stopped=job.stopped))
+    refresh_messages()
+    st.session_state.active_generation = None
+    
+    status.empty()
+    for view in views:
+        view.flush()
+    
+    # Completed responses fed the performance dashboard as they finished; stopped and replayed ones would skew it
+    for job in jobs:
+        if job.metrics_error:
+            st.error(f"Failed to record performance metrics: {job.metrics_error}")
+
+# Performance metrics store
+METRICS_DB_PATH = os.path.join('.streamlit_cache', 'metrics.db')
+METRIC_COLUMNS = [
+    'tokens', 'tokens_per_sec', 'ttft', 'load_duration', 'prompt_eval_count', 'prompt_eval_duration',
+    'prompt_tokens_per_sec', 'eval_duration', 'total_duration', 'latency'
+]
+
+class MetricsStore:
+    """Append-only SQLite log of per-response statistics, shared by every session in the process"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS response_metrics (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    recorded_at REAL NOT NULL,
+                    model TEXT NOT NULL,
+                    temperature REAL,
+                    top_p REAL,
+                    num_predict INTEGER,
+                    done_reason TEXT,
+                    {', '.join(f'{column} REAL' for column in METRIC_COLUMNS)}
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_metrics_model_time ON response_metrics (model, recorded_at)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def record(self, model, stats, temperature, top_p, num_predict):
+        """Append one completed response"""
+        columns = ['recorded_at', 'model', 'temperature', 'top_p', 'num_predict', 'done_reason'] + METRIC_COLUMNS
+        values = [time.time(), model, temperature, top_p, num_predict, stats.get('done_reason')]
+        values += [stats.get(column) for column in METRIC_COLUMNS]
+        with self.lock, self._connect() as conn:
+            conn.execute(
+                f"INSERT INTO response_metrics ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                values
+            )
+
+    def load(self, since=None):
+        """All recorded responses (optionally since a unix timestamp) as a DataFrame"""
+        query = "SELECT * FROM response_metrics"
+        params = []
+        if since is not None:
+            query += " WHERE recorded_at >= ?"
+            params.append(since)
+        with self._connect() as conn:
+            df = pd.read_sql_query(query + " ORDER BY recorded_at", conn, params=params)
+        df['recorded_at'] = pd.to_datetime(df['recorded_at'], unit='s')
+        return df
+
+@st.cache_resource(show_spinner=False)
+def get_metrics_store():
+    """Process-wide metrics store"""
+    return MetricsStore(METRICS_DB_PATH)
+
+# Conversation search index
+SEARCH_DB_PATH = os.path.join(CACHE_DIR, 'search.db')
+SEARCH_RESULT_LIMIT = 20
+
+def fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+def fts_query(text):
+    """Turn free text into an FTS5 query where every word must match as a prefix"""
+    return ' '.join(fts_phrase(word) + '*' for word in text.split())
+
+class ConversationSearchIndex:
+    """SQLite FTS5 index over every message of every saved conversation, scoped per session"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS indexed_conversations (
+                    session TEXT NOT NULL,
+                    conversation_id TEXT NOT NULL,
+                    message_count INTEGER NOT NULL,
+                    PRIMARY KEY (session, conversation_id)
+                )
+            """)
+            conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+                    content,
+                    session,
+                    conversation_id UNINDEXED,
+                    position UNINDEXED,
+                    tokenize = 'unicode61 remove_diacritics 2',
+                    prefix = '2 3'
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _delete(self, conn, session, conversation_id):
+        conn.execute(
+            "DELETE FROM message_fts WHERE rowid IN "
+            "(SELECT rowid FROM message_fts WHERE message_fts MATCH ? AND conversation_id = ?)",
+            (f"session : {fts_phrase(session)}", conversation_id)
+        )
+        conn.execute("DELETE FROM indexed_conversations WHERE session = ? AND conversation_id = ?",
+                     (session, conversation_id))
+
+    def index(self, session, conversation_id, messages, reindex=False):
+        """Add the messages not indexed yet; a rewritten or shrunken conversation is reindexed from scratch"""
+        with self.lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT message_count FROM indexed_conversations WHERE session = ? AND conversation_id = ?",
+                (session, conversation_id)
+            ).fetchone()
+            start = row[0] if row else 0
+            if start and (reindex or start > len(messages)):
+                self._delete(conn, session, conversation_id)
+                start = 0
+            conn.executemany(
+                "INSERT INTO message_fts (content, session, conversation_id, position) VALUES (?, ?, ?, ?)",
+                [(msg.get('content', ''), session, conversation_id, position)
+                 for position, msg in enumerate(messages[start:], start)]
+            )
+            conn.execute("INSERT OR REPLACE INTO indexed_conversations VALUES (?, ?, ?)",
+                         (session, conversation_id, len(messages)))
+
+    def delete(self, session, conversation_id):
+        with self.lock, self._connect() as conn:
+            self._delete(conn, session, conversation_id)
+
+    def indexed_ids(self, session):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT conversation_id FROM indexed_conversations WHERE session = ?", (session,))
+            return {row[0] for row in rows}
+
+    def search(self, session, text, limit=SEARCH_RESULT_LIMIT):
+        """Best-matching conversations ranked by bm25, each with a snippet of its best message"""
+        query = fts_query(text)
+        if not query:
+            return []
+        # The session is an indexed column, so scoping is a doclist intersection rather than a post-filter
+        query = f"session : {fts_phrase(session)} AND content : ({query})"
+        results = OrderedDict()
+        with self._connect() as conn:
+            rows = conn.execute("""
+                SELECT conversation_id, snippet(message_fts, 0, '**', '**', '…', 12)
+                FROM message_fts
+                WHERE message_fts MATCH ?
+                ORDER BY bm25(message_fts, 1.0, 0.0)
+                LIMIT ?
+            """, (query, limit * 10))
+            for conversation_id, snippet in rows:
+                results.setdefault(conversation_id, snippet)
+                if len(results) >= limit:
+                    break
+        return list(results.items())
+
+@st.cache_resource(show_spinner=False)
+def get_search_index():
+    """Process-wide search index"""
+    return ConversationSearchIndex(SEARCH_DB_PATH)
+
+def index_conversation(conversation_id, messages, reindex=False):
+    try:
+        get_search_index().index(session_key(), conversation_id, messages, reindex)
+    except sqlite3.Error as e:
+        st.error(f"Failed to update the search index: {e}")
+
+def search_conversations(text):
+    """Search this session's saved conversations and the one on screen, first indexing any the index has not seen yet"""
+    journal = conversation_journal()
+    index = get_search_index()
+    key = session_key()
+    current = current_history_entry()
+    if current:
+        # Only the messages added since the last search are indexed
+        index.index(key, current['id'], st.session_state.tree.message_log)
+    # Conversations saved by another replica or before the index existed are picked up here
+    for conversation_id in journal.history_ids() - index.indexed_ids(key):
+        transcript = journal.load_transcript(conversation_id)
+        if transcript:
+            index.index(key, conversation_id, transcript['tree'].message_log)
+    results = []
+    for conversation_id, snippet in index.search(key, text):
+        entry = current if current and conversation_id == current['id'] else journal.get_history(conversation_id)
+        if entry:
+            results.append((entry, snippet))
+    return results
 
 def copy_to_clipboard(text):
     """Create a copy button with JavaScript"""
@@ -849,30 +2581,271 @@ def copy_to_clipboard(text):
     </script>
     """
 
-def export_conversation(format='json'):
-    """Export conversation history"""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    
-    if format == 'json':
-        content = json.dumps(st.session_state.messages, indent=2)
-        mime = 'application/json'
-        ext = 'json'
-    elif format == 'markdown':
-        content = "# Conversation History\n\n"
-        for msg in st.session_state.messages:
-            role = msg['role'].capitalize()
-            content += f"## {role}\n{msg['content']}\n\n"
-        mime = 'text/markdown'
-        ext = 'md'
+# Conversation export and import
+EXPORT_FORMATS = {
+    'JSON': ('json', 'application/json'),
+    'JSONL': ('jsonl', 'application/x-ndjson'),
+    'Markdown': ('md', 'text/markdown'),
+    'Text': ('txt', 'text/plain'),
+    'Zip archive': ('zip', 'application/zip'),
+}
+IMPORT_READ_SIZE = 64 * 1024
+SAFE_CONVERSATION_ID = re.compile(r'[0-9A-Za-z_-]{1,64}')  # imported ids become blob names
+
+def iter_export_conversations(everything=False):
+    """(metadata, transcript) pairs to export; saved conversations are loaded one at a time"""
+    if not everything:
+        if st.session_state.messages:
+            entry = {
+                'id': st.session_state.conversation_id or uuid.uuid4().hex,
+                'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                'summary': generate_conversation_summary(st.session_state.messages),
+                'model': (st.session_state.get('selected_models') or [''])[0]
+            }
+            yield entry, {'tree': st.session_state.tree, 'system_prompt': st.session_state.get('system_prompt', '')}
+        return
+    # The current chat goes into history first, so it is part of the archive
+    save_conversation_history()
+    journal = conversation_journal()
+    for entry in journal.history_entries():
+        transcript = journal.load_transcript(entry['id'])
+        if transcript is not None:
+            yield entry, transcript
+
+def export_record(entry, transcript):
+    """Portable form of a conversation: metadata plus the whole tree, every branch included"""
+    tree = transcript['tree']
+    return {
+        'id': entry['id'],
+        'timestamp': entry.get('timestamp', ''),
+        'summary': entry.get('summary', ''),
+        'model': entry.get('model', ''),
+        'system_prompt': transcript.get('system_prompt', ''),
+        'tree': {
+            'leaf': tree.leaf,
+            'turns': [{'id': turn.id, 'parent': turn.parent, 'messages': [msg.to_dict() for msg in turn.messages]}
+                      for turn in tree.turns.values()]
+        }
+    }
+
+def export_chunks(conversations, ext):
+    """Yield the export as text pieces, one conversation at a time; text formats show the active branch"""
+    if ext == 'json':
+        yield '['
+        for position, (entry, transcript) in enumerate(conversations):
+            yield (',\n' if position else '\n') + json.dumps(export_record(entry, transcript), indent=2)
+        yield '\n]\n'
+    elif ext == 'jsonl':
+        for entry, transcript in conversations:
+            yield json.dumps(export_record(entry, transcript), separators=(',', ':')) + '\n'
+    elif ext == 'md':
+        for entry, transcript in conversations:
+            yield f"# {entry.get('summary', 'Conversation')}\n\n"
+            yield f"*{entry.get('timestamp', '')}" + (f" · {entry['model']}" if entry.get('model') else '') + "*\n\n"
+            for msg in transcript['tree'].messages():
+                yield f"## {msg['role'].capitalize()}\n{msg['content']}\n\n"
     else:  # txt
-        content = ""
-        for msg in st.session_state.messages:
-            role = msg['role'].upper()
-            content += f"{role}: {msg['content']}\n\n"
-        mime = 'text/plain'
-        ext = 'txt'
+        for entry, transcript in conversations:
+            yield f"=== {entry.get('summary', 'Conversation')} ({entry.get('timestamp', '')}) ===\n\n"
+            for msg in transcript['tree'].messages():
+                yield f"{msg['role'].upper()}: {msg['content']}\n\n"
+
+def write_export(ext, everything=False):
+    """Build an export on request, writing each conversation out before the next one is loaded"""
+    buffer = io.BytesIO()
+    conversations = iter_export_conversations(everything)
+    if ext == 'zip':
+        # One JSON file per conversation, compressed as it is written
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for entry, transcript in conversations:
+                with archive.open(f"conversations/{entry['id']}.json", 'w') as member:
+                    member.write(json.dumps(export_record(entry, transcript), indent=2).encode('utf-8'))
+    else:
+        for chunk in export_chunks(conversations, ext):
+            buffer.write(chunk.encode('utf-8'))
+    buffer.seek(0)
+    return buffer
+
+def iter_json_values(stream):
+    """Parse consecutive JSON values, or the elements of a top-level array, from a text stream piece by piece"""
+    decoder = json.JSONDecoder()
+    buffer, pos, opened = '', 0, False
+    read_size = IMPORT_READ_SIZE
+    while True:
+        while pos < len(buffer) and (buffer[pos] in ' \t\r\n,' or (buffer[pos] == '[' and not opened)):
+            opened = opened or buffer[pos] == '['
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == ']':
+            return
+        if pos < len(buffer):
+            try:
+                value, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # The value runs past what has been read; read more, doubling so large values parse in linear time
+                read_size = max(read_size, len(buffer) - pos)
+            else:
+                read_size = IMPORT_READ_SIZE
+                yield value
+                continue
+        chunk = stream.read(read_size)
+        if not chunk:
+            if buffer[pos:].strip():
+                raise ValueError("The file ends in the middle of a conversation")
+            return
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+def iter_import_records(uploaded_file):
+    """Conversation records from an uploaded JSON, JSONL or zip export, read one at a time"""
+    uploaded_file.seek(0)
+    if zipfile.is_zipfile(uploaded_file):
+        uploaded_file.seek(0)
+        with zipfile.ZipFile(uploaded_file) as archive:
+            for info in archive.infolist():
+                if info.filename.endswith(('.json', '.jsonl')):
+                    with archive.open(info) as member:
+                        yield from iter_json_records(io.TextIOWrapper(member, encoding='utf-8'))
+    else:
+        uploaded_file.seek(0)
+        yield from iter_json_records(io.TextIOWrapper(uploaded_file, encoding='utf-8'))
+
+def iter_json_records(stream):
+    messages = []
+    for value in iter_json_values(stream):
+        if not isinstance(value, dict):
+            raise ValueError("Not a conversation export")
+        if 'role' in value:
+            messages.append(value)  # a flat message list, as exported before conversations had metadata
+        else:
+            yield value
+    if messages:
+        yield {'messages': messages}
+
+def import_conversation(record):
+    """Save one exported conversation into this session's history"""
+    tree = tree_from_storage(record)
+    if not tree.message_log:
+        raise ValueError("No messages")
+    tree.validate()  # a dangling or looping parent would break every later render of this conversation
+    conversation_id = record.get('id')
+    if not isinstance(conversation_id, str) or not SAFE_CONVERSATION_ID.fullmatch(conversation_id):
+        conversation_id = uuid.uuid4().hex
+    fingerprint = ConversationFingerprint()
+    fingerprint.update(tree.message_log)
+    entry = {
+        'id': conversation_id,
+        'timestamp': record.get('timestamp') or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'summary': record.get('summary') or generate_conversation_summary(tree.messages()),
+        'model': record.get('model', ''),
+        'message_count': len(tree.message_log),
+        'digest': f"{fingerprint.digest}:{tree.leaf}"
+    }
+    conversation_journal().put_history(entry, {'tree': tree.to_dict(), 'system_prompt': record.get('system_prompt', '')})
+    index_conversation(conversation_id, tree.message_log, reindex=True)
+
+def import_conversations(uploaded_file):
+    """Stream an uploaded export into history; returns how many conversations were imported and skipped"""
+    imported = skipped = 0
+    for record in iter_import_records(uploaded_file):
+        try:
+            import_conversation(record)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            skipped += 1
+            continue
+        imported += 1
+    enforce_history_budget(keep=st.session_state.conversation_id)
+    st.session_state.history_page = 0
+    return imported, skipped
+
+# Performance dashboard
+DASHBOARD_RANGES = {"Last 24 hours": 1, "Last 7 days": 7, "Last 30 days": 30, "All time": None}
+DASHBOARD_METRICS = {
+    "Time to first token (s)": 'ttft',
+    "Decode speed (tok/s)": 'tokens_per_sec',
+    "Prompt speed (tok/s)": 'prompt_tokens_per_sec',
+    "Model load time (s)": 'load_duration',
+    "End-to-end latency (s)": 'latency'
+}
+
+def render_semantic_cache_metrics():
+    """Hit rate and latency of this session's semantic cache since the app started"""
+    if not st.session_state.semantic_cache:
+        return
+    metrics = get_semantic_cache(st.session_state.embedding_model).summary()
+    lookups = metrics['lookups']
+    st.subheader("Semantic cache")
+    cols = st.columns(5)
+    cols[0].metric("Cached replies", metrics['entries'])
+    cols[1].metric("Hit rate", f"{metrics['hits'] / lookups:.0%}" if lookups else "–", f"{lookups} lookups", delta_color="off")
+    embeddings = metrics['embeddings']
+    cols[2].metric("Embedding", f"{metrics['embed_seconds'] / embeddings * 1000:.0f} ms" if embeddings else "–",
+                   f"{metrics['errors']} failed" if metrics['errors'] else None, delta_color="off")
+    cols[3].metric("Search", f"{metrics['search_seconds'] / lookups * 1000:.2f} ms" if lookups else "–")
+    cols[4].metric("Index load", f"{metrics['build_seconds'] * 1000:.0f} ms")
+
+def render_performance_dashboard():
+    """Per-model latency and throughput percentiles and trends from the metrics store"""
+    st.title("Performance Dashboard")
+    render_semantic_cache_metrics()
     
-    return content, f"conversation_{timestamp}.{ext}", mime
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        range_label = st.selectbox("Time range", list(DASHBOARD_RANGES), index=1)
+    days = DASHBOARD_RANGES[range_label]
+    since = time.time() - days * 86400 if days else None
+    
+    try:
+        df = get_metrics_store().load(since)
+    except sqlite3.Error as e:
+        st.error(f"Failed to load performance metrics: {e}")
+        return
+    if df.empty:
+        st.info("No responses recorded yet. Metrics are stored for every completed response.")
+        return
+    
+    with col2:
+        models = st.multiselect("Models", sorted(df['model'].unique()), default=sorted(df['model'].unique()))
+    
+    # Parameter filters
+    with st.expander("🎛️ Parameter filters", expanded=False):
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            temperature = st.slider("Temperature", 0.0, 2.0, (0.0, 2.0), 0.1)
+        with col2:
+            top_p = st.slider("Top P", 0.0, 1.0, (0.0, 1.0), 0.1)
+        with col3:
+            num_predict_values = sorted(df['num_predict'].dropna().unique().astype(int))
+            num_predict = st.multiselect("Max Tokens", num_predict_values, default=num_predict_values)
+    
+    df = df[
+        df['model'].isin(models)
+        & df['temperature'].between(*temperature)
+        & df['top_p'].between(*top_p)
+        & df['num_predict'].isin(num_predict)
+    ]
+    if df.empty:
+        st.warning("No responses match these filters.")
+        return
+    
+    # Percentile summary per model
+    st.subheader("Summary")
+    grouped = df.groupby('model')
+    summary = pd.DataFrame({'Responses': grouped.size()})
+    for label, column in DASHBOARD_METRICS.items():
+        summary[f"{label} p50"] = grouped[column].quantile(0.5)
+        summary[f"{label} p95"] = grouped[column].quantile(0.95)
+    st.dataframe(summary.round(2), use_container_width=True)
+    
+    # Trends over time
+    st.subheader("Trends")
+    metric_label = st.selectbox("Metric", list(DASHBOARD_METRICS))
+    column = DASHBOARD_METRICS[metric_label]
+    bucket = 'h' if days == 1 else 'D'
+    trend = df.assign(period=df['recorded_at'].dt.floor(bucket)).pivot_table(
+        index='period', columns='model', values=column, aggfunc='median'
+    )
+    st.line_chart(trend)
+    st.caption(f"Median per {'hour' if bucket == 'h' else 'day'} for each model")
 
 # Main UI
 apply_custom_css()
@@ -881,6 +2854,8 @@ apply_custom_css()
 with st.sidebar:
     st.title("🤖 Ollama Chat Studio")
     
+    view = st.radio("View", ["💬 Chat", "📈 Performance"], horizontal=True, label_visibility="collapsed")
+    
     # Connection status indicator
     is_connected, status_msg = check_ollama_connection()
     if is_connected:
@@ -888,24 +2863,97 @@ with st.sidebar:
     else:
         st.error(f"🔴 Ollama: {status_msg}")
     
+    with st.expander("🔌 Connection", expanded=not is_connected):
+        if ALLOW_URL_OVERRIDE:
+            base_url = st.text_input(
+                "Ollama URLs", value=st.session_state.ollama_base_url,
+                help="One server, or several separated by commas to spread models and requests across them. "
+                     "Defaults to the OLLAMA_CHAT_NODES or OLLAMA_HOST environment variable."
+            )
+            if parse_node_urls(base_url) != parse_node_urls(st.session_state.ollama_base_url):
+                st.session_state.ollama_base_url = base_url
+                st.rerun()
+        else:
+            st.caption(f"Ollama: {', '.join(parse_node_urls(DEFAULT_OLLAMA_URL))} "
+                       "(set with OLLAMA_CHAT_NODES or OLLAMA_HOST)")
+        node_results = ollama_router().node_results()
+        if len(node_results) > 1:
+            for node, result in node_results:
+                if result['connected']:
+                    st.caption(f"🟢 {node.base_url} · {len(result['models'])} models · "
+                               f"{len(result['loaded'])} loaded · {node.in_flight} running")
+                else:
+                    st.caption(f"🔴 {node.base_url} · {result['status']}")
+    
     # Message History Navigation
-    if 'conversation_history' in st.session_state and st.session_state.conversation_history:
-        with st.expander("📚 Conversation History", expanded=False):
-            st.write("Quick navigation to previous conversations:")
-            for i, conv in enumerate(st.session_state.conversation_history[:10]):  # Show last 10
+    # Only one page of metadata is fetched per run; transcripts load when an entry is clicked
+    journal = conversation_journal()
+    page = st.session_state.history_page
+    history_entries, history_total = journal.history_page(page, HISTORY_PAGE_SIZE)
+    if not history_entries and page:
+        page = st.session_state.history_page = max(history_total - 1, 0) // HISTORY_PAGE_SIZE
+        history_entries, history_total = journal.history_page(page, HISTORY_PAGE_SIZE)
+    # The conversation on screen heads the list with its live state, in place of its last saved copy
+    current = current_history_entry()
+    if current:
+        history_total += journal.get_history(current['id']) is None
+        history_entries = [conv for conv in history_entries if conv['id'] != current['id']]
+        if page == 0:
+            history_entries.insert(0, current)
+    if history_total:
+        with st.expander(f"📚 Conversation History ({history_total})", expanded=False):
+            busy = bool(st.session_state.get('active_generation'))
+            search_text = st.text_input("🔎 Search", key="history_search", placeholder="Words or word prefixes")
+            if search_text.strip():
+                try:
+                    search_results = search_conversations(search_text)
+                except sqlite3.Error as e:
+                    st.error(f"Search failed: {e}")
+                    search_results = []
+                if not search_results:
+                    st.caption("No matching conversations")
+                for conv, snippet in search_results:
+                    st.caption(f"{'💬 Current' if conv.get('current') else '🕒 ' + conv['timestamp'][:16]} · {snippet}")
+                    if st.button(f"💬 {conv['summary'][:40]}", key=f"search_conv_{conv['id']}", help=conv['summary'],
+                                 disabled=busy or conv.get('current', False)):
+                        if load_conversation_from_history(conv):
+                            st.rerun()
+                history_entries = []
+            else:
+                st.write("Quick navigation to previous conversations:")
+            for conv in history_entries:
                 col1, col2 = st.columns([4, 1])
                 with col1:
                     # Truncate summary for display
                     display_summary = conv['summary'][:40] + "..." if len(conv['summary']) > 40 else conv['summary']
-                    st.caption(f"🕒 {conv['timestamp'][:16]}")
-                    if st.button(f"💬 {display_summary}", key=f"load_conv_{i}", help=conv['summary']):
-                        load_conversation_from_history(conv)
-                        st.rerun()
+                    if conv.get('current'):
+                        st.caption(f"💬 Current · {conv['message_count']} messages")
+                    else:
+                        st.caption(f"🕒 {conv['timestamp'][:16]} · {conv['message_count']} messages")
+                    if st.button(f"💬 {display_summary}", key=f"load_conv_{conv['id']}", help=conv['summary'],
+                                 disabled=busy or conv.get('current', False)):
+                        if load_conversation_from_history(conv):
+                            st.rerun()
                 with col2:
-                    if st.button("🗑️", key=f"del_conv_{i}", help="Delete conversation"):
-                        st.session_state.conversation_history.pop(i)
+                    if not conv.get('current') and st.button("🗑️", key=f"del_conv_{conv['id']}",
+                                                             help="Delete conversation"):
+                        journal.delete_history(conv['id'])
+                        get_search_index().delete(session_key(), conv['id'])
                         st.rerun()
                 st.divider()
+            pages = (history_total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+            if pages > 1 and history_entries:
+                col1, col2, col3 = st.columns([1, 2, 1])
+                with col1:
+                    if st.button("◀", key="history_prev", disabled=page == 0):
+                        st.session_state.history_page -= 1
+                        st.rerun()
+                with col2:
+                    st.caption(f"Page {page + 1} of {pages}")
+                with col3:
+                    if st.button("▶", key="history_next", disabled=page >= pages - 1):
+                        st.session_state.history_page += 1
+                        st.rerun()
     
     # Theme toggle
     col1, col2 = st.columns(2)
@@ -931,9 +2979,44 @@ with st.sidebar:
                 default=st.session_state.selected_models[:len(available_models)] if st.session_state.selected_models else []
             )
             st.session_state.selected_models = selected_models
+            st.session_state.max_parallel_streams = st.number_input(
+                "Max parallel streams", 1, 16, st.session_state.max_parallel_streams,
+                help="How many of your models generate at once. Server-wide limits follow OLLAMA_NUM_PARALLEL and "
+                     "OLLAMA_MAX_LOADED_MODELS in the app's environment."
+            )
         else:
             selected_model = st.selectbox("Select model:", available_models)
             st.session_state.selected_models = [selected_model]
+        
+        preload_new_selections()
+        
+        # Warm-up and keep-alive
+        with st.expander("🔥 Keep-alive & Preloading", expanded=False):
+            st.session_state.preload_models = st.checkbox(
+                "Preload models when selected", value=st.session_state.preload_models,
+                help="Load newly selected models in the background so the first message doesn't wait for them."
+            )
+            for model in st.session_state.selected_models:
+                current = st.session_state.keep_alive.get(model, "Server default")
+                st.session_state.keep_alive[model] = st.selectbox(
+                    f"Keep {model} loaded for", list(KEEP_ALIVE_OPTIONS),
+                    index=list(KEEP_ALIVE_OPTIONS).index(current) if current in KEEP_ALIVE_OPTIONS else 0,
+                    key=f"keep_alive_{model}"
+                )
+            
+            loaded_models = get_loaded_models()
+            loading = models_loading()
+            multi_node = len({loaded['node'] for loaded in loaded_models}) > 1
+            st.caption("In memory:")
+            for loaded in loaded_models:
+                vram = loaded.get('size_vram', 0) / 1024 ** 3
+                until = loaded.get('expires_at', '')[11:16]
+                st.caption(f"🟢 {loaded['name']} · {vram:.1f} GB VRAM" + (f" · until {until}" if until else "")
+                           + (f" · {loaded['node']}" if multi_node else ""))
+            for model in sorted(loading):
+                st.caption(f"⏳ {model} loading...")
+            if not loaded_models and not loading:
+                st.caption("No models loaded")
     
     # Model parameters
     with st.expander("⚙️ Model Parameters", expanded=False):
@@ -946,6 +3029,43 @@ with st.sidebar:
         st.session_state.max_tokens = st.number_input(
             "Max Tokens", 1, 8192, st.session_state.max_tokens
         )
+        st.session_state.native_thinking = st.checkbox(
+            "Native thinking", value=st.session_state.native_thinking,
+            help="Ask models that report the 'thinking' capability to return their reasoning separately (Ollama's think option)."
+        )
+    
+    # Performance settings
+    with st.expander("⚡ Performance", expanded=False):
+        st.session_state.render_interval_ms = st.slider(
+            "Stream refresh interval (ms)", 0, 500, st.session_state.render_interval_ms, 25,
+            help="How often streaming text is redrawn. Higher values use less browser and network work on long answers; 0 redraws on every chunk."
+        )
+        st.session_state.delta_streaming = st.checkbox(
+            "Delta streaming", value=st.session_state.delta_streaming,
+            help="Send each finished paragraph or code block to the browser once and only redraw the part still being written."
+        )
+        st.session_state.response_cache = st.checkbox(
+            "Cache deterministic replies", value=st.session_state.response_cache,
+            help="At temperature 0, reuse the stored reply when the same model build gets exactly the same "
+                 "conversation and parameters again. Replies are shared across users of this app."
+        )
+        st.session_state.semantic_cache = st.checkbox(
+            "Semantic cache", value=st.session_state.semantic_cache,
+            help="Answer a question instantly with the reply to a near-identical earlier one in the same context, "
+                 "found by comparing embeddings. Only this session's own replies are reused. Regenerate always asks the model."
+        )
+        if st.session_state.semantic_cache:
+            st.session_state.semantic_threshold = st.slider(
+                "Similarity threshold", 0.80, 1.0, float(st.session_state.semantic_threshold), 0.01,
+                help="How close a question must be to a cached one (cosine similarity of their embeddings)"
+            )
+            embedding_models = available_models or [st.session_state.embedding_model]
+            if st.session_state.embedding_model not in embedding_models:
+                embedding_models = [st.session_state.embedding_model] + embedding_models
+                st.warning(f"Pull {st.session_state.embedding_model} or choose an installed embedding model.")
+            st.session_state.embedding_model = st.selectbox(
+                "Embedding model", embedding_models, index=embedding_models.index(st.session_state.embedding_model)
+            )
     
     # System prompt
     with st.expander("📝 System Prompt", expanded=False):
@@ -961,29 +3081,59 @@ with st.sidebar:
     col1, col2 = st.columns(2)
     with col1:
         if st.button("🗑️ Clear Chat"):
+            cancel_generation()
+            st.session_state.active_generation = None
             # Save current conversation to history before clearing
             if st.session_state.messages:
                 save_conversation_history()
-            st.session_state.messages = []
+            start_new_conversation()
             st.session_state.show_thinking = {}
             st.rerun()
     
     with col2:
-        if st.button("🔄 Regenerate"):
-            if st.session_state.messages and st.session_state.messages[-1]['role'] == 'assistant':
-                st.session_state.messages.pop()
+        if st.button("🔄 Regenerate", disabled=bool(st.session_state.get('active_generation')),
+                     help="Answer the last message again in a new branch; earlier answers stay available"):
+            tree = st.session_state.tree
+            leaf = tree.turns.get(tree.leaf)
+            if leaf and leaf.messages[0]['role'] == 'user' and st.session_state.selected_models:
+                # A sibling turn sharing the same user message object
+                tree.add_turn([leaf.messages[0]], parent=leaf.parent)
+                refresh_messages()
+                save_conversation_state()
+                generate_replies(use_cache=False)
                 st.rerun()
     
-    # Export options
-    with st.expander("💾 Export Conversation", expanded=False):
-        export_format = st.selectbox("Format:", ['json', 'markdown', 'txt'])
-        content, filename, mime = export_conversation(export_format)
-        st.download_button(
-            label="Download",
-            data=content,
-            file_name=filename,
-            mime=mime
+    # Export and import
+    with st.expander("💾 Export & Import", expanded=False):
+        export_scope = st.radio("Conversations:", ["This conversation", "All conversations"], horizontal=True)
+        export_format = st.selectbox("Format:", list(EXPORT_FORMATS))
+        # Built only when asked for, rather than on every rerun
+        if st.button("Prepare export"):
+            ext, mime = EXPORT_FORMATS[export_format]
+            everything = export_scope == "All conversations"
+            with st.spinner("Preparing export..."):
+                export_file = write_export(ext, everything)
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            st.download_button(
+                label="Download",
+                data=export_file,
+                file_name=f"{'conversations' if everything else 'conversation'}_{timestamp}.{ext}",
+                mime=mime
+            )
+        
+        uploaded_export = st.file_uploader(
+            "Import conversations", type=['json', 'jsonl', 'zip'],
+            help="A JSON, JSONL or zip export from this app. Conversations are added to your history."
         )
+        if uploaded_export is not None and st.button("Import"):
+            try:
+                with st.spinner("Importing..."):
+                    imported, skipped = import_conversations(uploaded_export)
+            except (ValueError, zipfile.BadZipFile) as e:
+                st.error(f"Failed to import conversations: {e}")
+            else:
+                st.success(f"Imported {imported} conversation{'s' if imported != 1 else ''}"
+                           + (f", skipped {skipped} unreadable" if skipped else ""))
 
     # Model Management
     with st.expander("🛠️ Manage Models", expanded=True):
@@ -1010,19 +3160,36 @@ with st.sidebar:
         else:
             st.info("No models currently installed.")
 
+# Persist sidebar changes (settings, cleared or loaded chats); a no-op when nothing changed
+save_conversation_state()
+
+# Performance view replaces the chat area; running generations continue in the background
+if view == "📈 Performance":
+    render_performance_dashboard()
+    st.stop()
+
 # Main chat area
 st.title("Chat Interface")
 
-# Display token count for input
+# Display prompt size against the context window
 if st.session_state.messages:
-    last_user_msg = next((msg for msg in reversed(st.session_state.messages) if msg['role'] == 'user'), None)
-    if last_user_msg:
-        token_estimate = len(last_user_msg['content'].split()) * 1.3  # Rough estimate
-        st.caption(f"Last input: ~{int(token_estimate)} tokens")
+    shown_models = [m for m in st.session_state.selected_models if m]
+    if not st.session_state.comparison_mode:
+        shown_models = shown_models[:1]
+    if shown_models:
+        st.caption(context_caption(shown_models))
 
 # Chat history display
 if st.session_state.comparison_mode and len(st.session_state.selected_models) > 1:
     # Display in columns for comparison
+    # A turn spans every column, so its branch controls are gathered above them
+    path = st.session_state.tree.path()
+    if len(path) > 1 or any(len(st.session_state.tree.siblings(turn.id)) > 1 for turn in path):
+        with st.expander("🌿 Branches", expanded=False):
+            for turn_number, turn in enumerate(path, 1):
+                st.caption(f"Turn {turn_number}: {turn.messages[0]['content'][:60]}")
+                render_branch_controls(turn)
+    
     cols = st.columns(len(st.session_state.selected_models))
     
     for idx, model in enumerate(st.session_state.selected_models):
@@ -1037,161 +3204,68 @@ if st.session_state.comparison_mode and len(st.session_state.selected_models) >
                     response_data = msg.get('response_data', {})
                     clean_content = response_data.get('clean_content', msg['content'])
                     thinking = response_data.get('thinking', None)
-                    stats = response_data.get('stats', {})
                     
                     st.markdown(f"**{model}:**")
                     st.markdown(clean_content)
                     
                     # Show stats
-                    if stats:
-                        st.caption(f"📊 {stats.get('tokens', 0)} tokens | {stats.get('tokens_per_sec', 0):.1f} tok/s")
+                    caption = stats_caption(response_data)
+                    if caption:
+                        st.caption(caption)
                     
                     # Thinking tokens in expander
                     if thinking:
                         with st.expander("🤔 Thinking Process", expanded=False):
                             st.markdown(f"```\n{thinking}\n```")
 else:
-    # Single model display
-    for msg in st.session_state.messages:
-        if msg['role'] == 'user':
-            with st.chat_message("user"):
-                st.markdown(msg['content'])
-        elif msg['role'] == 'assistant':
-            with st.chat_message("assistant"):
-                response_data = msg.get('response_data', {})
-                clean_content = response_data.get('clean_content', msg['content'])
-                thinking = response_data.get('thinking', None)
-                stats = response_data.get('stats', {})
-                
-                st.markdown(clean_content)
-                
-                # Show stats
-                if stats:
-                    st.caption(f"📊 {stats.get('tokens', 0)} tokens | {stats.get('tokens_per_sec', 0):.1f} tok/s")
-                
-                # Thinking tokens in expander
-                if thinking:
-                    with st.expander("🤔 Thinking Process", expanded=False):
-                        st.markdown(f"```\n{thinking}\n```")
+    # Single model display, one turn at a time so each can carry its branch controls
+    for turn in st.session_state.tree.path():
+        for msg in turn.messages:
+            if msg['role'] == 'user':
+                with st.chat_message("user"):
+                    st.markdown(msg['content'])
+            elif msg['role'] == 'assistant':
+                with st.chat_message("assistant"):
+                    response_data = msg.get('response_data', {})
+                    clean_content = response_data.get('clean_content', msg['content'])
+                    thinking = response_data.get('thinking', None)
+                    
+                    st.markdown(clean_content)
+                    
+                    # Show stats
+                    caption = stats_caption(response_data)
+                    if caption:
+                        st.caption(caption)
+                    
+                    # Thinking tokens in expander
+                    if thinking:
+                        with st.expander("🤔 Thinking Process", expanded=False):
+                            st.markdown(f"```\n{thinking}\n```")
+        render_branch_controls(turn)
 
 # Chat input
 # User input
 st.info("💡 **Pro tip:** Press Enter to send, Shift+Enter for new line")
-user_input = st.chat_input("Type your message... (Press Enter to send)")
+user_input = st.chat_input(
+    "Type your message... (Press Enter to send)",
+    disabled=bool(st.session_state.get('active_generation'))
+)
 
 if user_input and st.session_state.selected_models:
-    # Add user message
-    st.session_state.messages.append({"role": "user", "content": user_input})
+    # Add user message as a new turn on the active branch
+    st.session_state.tree.add_turn([Message("user", user_input)])
+    refresh_messages()
     # Auto-save conversation state after each message
     save_conversation_state()
     
-    # Prepare messages for API
-    api_messages = [{"role": "system", "content": st.session_state.system_prompt}]
-    for msg in st.session_state.messages:
-        if msg['role'] == 'user':
-            api_messages.append({"role": "user", "content": msg['content']})
-        elif msg['role'] == 'assistant' and not msg.get('model'):
-            # Include previous responses for context
-            api_messages.append({"role": "assistant", "content": msg['content']})
-    
-    # Generate responses
-    if st.session_state.comparison_mode and len(st.session_state.selected_models) > 1:
-        # Multiple model responses
-        response_cols = st.columns(len(st.session_state.selected_models))
-        
-        for idx, model in enumerate(st.session_state.selected_models):
-            with response_cols[idx]:
-                st.markdown(f"**{model}:**")
-                response_placeholder = st.empty()
-                
-                full_response = ""
-                final_stats = {}
-                
-                for chunk, tokens, time_or_tps in stream_ollama_response(
-                    model, api_messages, 
-                    st.session_state.temperature,
-                    st.session_state.top_p,
-                    st.session_state.max_tokens
-                ):
-                    if chunk is not None:
-                        full_response += chunk
-                        response_placeholder.markdown(full_response + "▌")
-                    else:
-                        final_stats = {'tokens': tokens, 'tokens_per_sec': time_or_tps}
-                
-                # Process thinking tokens
-                clean_content, thinking = extract_thinking_tokens(full_response)
-                response_placeholder.markdown(clean_content)
-                
-                # Store in session state
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": clean_content,
-                    "model": model,
-                    "response_data": {
-                        "clean_content": clean_content,
-                        "thinking": thinking,
-                        "stats": final_stats
-                    }
-                })
-                
-                # Display stats
-                if final_stats:
-                    st.caption(f"📊 {final_stats['tokens']} tokens | {final_stats['tokens_per_sec']:.1f} tok/s")
-                
-                # Display thinking if present
-                if thinking:
-                    with st.expander("🤔 Thinking Process", expanded=False):
-                        st.markdown(f"```\n{thinking}\n```")
-    else:
-        # Single model response
-        model = st.session_state.selected_models[0]
-        
-        with st.chat_message("assistant"):
-            response_placeholder = st.empty()
-            
-            full_response = ""
-            final_stats = {}
-            
-            for chunk, tokens, time_or_tps in stream_ollama_response(
-                model, api_messages,
-                st.session_state.temperature,
-                st.session_state.top_p,
-                st.session_state.max_tokens
-            ):
-                if chunk is not None:
-                    full_response += chunk
-                    response_placeholder.markdown(full_response + "▌")
-                else:
-                    final_stats = {'tokens': tokens, 'tokens_per_sec': time_or_tps}
-            
-            # Process thinking tokens
-            clean_content, thinking = extract_thinking_tokens(full_response)
-            response_placeholder.markdown(clean_content)
-            
-            # Store in session state
-            st.session_state.messages.append({
-                "role": "assistant",
-                "content": clean_content,
-                "response_data": {
-                    "clean_content": clean_content,
-                    "thinking": thinking,
-                    "stats": final_stats
-                }
-            })
-            
-            # Display stats
-            if final_stats:
-                st.caption(f"📊 {final_stats['tokens']} tokens | {final_stats['tokens_per_sec']:.1f} tok/s")
-            
-            # Display thinking if present
-            if thinking:
-                with st.expander("🤔 Thinking Process", expanded=False):
-                    st.markdown(f"```\n{thinking}\n```")
+    # Generate responses in the background; they are streamed in below
+    generate_replies()
+
+if st.session_state.get('active_generation'):
+    render_active_generation()
     
     # Auto-save after generating responses
     save_conversation_state()
-    save_conversation_history()  # Save to history for navigation
     st.rerun()
 
 # Footer
@@ -0,0 +1,1019 @@
+"""Conversation storage, generation scheduling and thinking-tag parsing for ollama-chat-app.py
+
+Kept free of Streamlit so it can be imported (and tested) on its own; the app wires these pieces
+to session state and its process-wide caches.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+import atexit
+import uuid
+import zlib
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice, zip_longest
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+try:
+    import zstandard
+except ImportError:  # optional; stored transcripts fall back to zlib
+    zstandard = None
+
+# Chat messages
+_MISSING = object()
+
+class Message:
+    """Chat message in __slots__ form, with the dict-style access the rest of the app was written against
+
+    clean_content is only kept when it differs from content, so both names share one string, and the
+    response_data dict is built on access instead of being stored per message. tokens caches the message's
+    share of the prompt once Ollama has counted it (see count_message_tokens); it is derived, never saved.
+    """
+    __slots__ = ('role', 'content', 'model', '_clean_content', 'thinking', 'stats', 'stopped', 'has_response_data',
+                 'tokens')
+
+    def __init__(self, role, content, model=None, clean_content=None, thinking=None, stats=None,
+                 stopped=False, has_response_data=False):
+        self.role = role
+        self.content = content
+        self.model = model
+        self._clean_content = None if clean_content is None or clean_content == content else clean_content
+        self.thinking = thinking
+        self.stats = stats
+        self.stopped = stopped
+        self.has_response_data = has_response_data
+        self.tokens = None
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build from the plain-dict form used by saved state and older sessions"""
+        if isinstance(data, Message):
+            return data
+        response_data = data.get('response_data')
+        if response_data is None:
+            return cls(data['role'], data['content'], data.get('model'))
+        return cls(data['role'], data['content'], data.get('model'),
+                   clean_content=response_data.get('clean_content'),
+                   thinking=response_data.get('thinking'),
+                   stats=response_data.get('stats') or {},
+                   stopped=response_data.get('stopped', False),
+                   has_response_data=True)
+
+    @property
+    def clean_content(self):
+        return self.content if self._clean_content is None else self._clean_content
+
+    @property
+    def response_data(self):
+        if not self.has_response_data:
+            return None
+        response_data = {'clean_content': self.clean_content, 'thinking': self.thinking, 'stats': self.stats}
+        if self.stopped:
+            response_data['stopped'] = True
+        return response_data
+
+    def keys(self):
+        keys = ['role', 'content']
+        if self.model is not None:
+            keys.append('model')
+        if self.has_response_data:
+            keys.append('response_data')
+        return keys
+
+    def to_dict(self, compact=False):
+        """Plain-dict form; compact drops clean_content where it only repeats content"""
+        data = {key: self[key] for key in self.keys()}
+        if compact and self.has_response_data and self._clean_content is None:
+            del data['response_data']['clean_content']
+        return data
+
+    def get(self, key, default=None):
+        if key == 'role' or key == 'content':
+            return getattr(self, key)
+        if key == 'model':
+            return default if self.model is None else self.model
+        if key == 'response_data':
+            return self.response_data if self.has_response_data else default
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __repr__(self):
+        return f"Message({self.to_dict()!r})"
+
+class Turn:
+    """One step of a conversation: the user message and the replies to it"""
+    __slots__ = ('id', 'parent', 'messages')
+
+    def __init__(self, turn_id, parent, messages):
+        self.id = turn_id
+        self.parent = parent
+        self.messages = messages
+
+class ConversationTree:
+    """Conversation turns linked to their parent turn, so alternative branches share their common prefix
+
+    st.session_state.messages is the flattened active branch. Every change is also queued in ops,
+    which the journal drains to persist the tree incrementally. Turn ids are random, so turns started
+    by two writers of the same session never collide (trees saved earlier use small integers).
+    """
+
+    def __init__(self, tree_id=None):
+        self.tree_id = tree_id or uuid.uuid4().hex  # identifies this tree to the journal
+        self.turns = {}         # turn id -> Turn, in creation order
+        self.children = {}      # parent turn id (None for first turns) -> child turn ids, oldest first
+        self.leaf = None        # last turn of the active branch
+        self.message_log = []   # every message in the order it was added; append-only
+        self.ops = []           # changes not yet handed to the journal
+
+    def _add_turn(self, turn_id, parent, messages):
+        turn = Turn(turn_id, parent, list(messages))
+        self.turns[turn_id] = turn
+        self.children.setdefault(parent, []).append(turn_id)
+        self.message_log.extend(turn.messages)
+        return turn
+
+    def add_turn(self, messages, parent=_MISSING):
+        """Start a turn under parent (by default the active leaf) and make it the active branch"""
+        parent = self.leaf if parent is _MISSING else parent
+        turn = self._add_turn(uuid.uuid4().hex, parent, messages)
+        self.ops.append({'op': 'turn', 'id': turn.id, 'parent': parent, 'messages': list(messages)})
+        self.set_leaf(turn.id)
+        return turn
+
+    def add_reply(self, turn_id, message):
+        turn = self.turns[turn_id]
+        self.ops.append({'op': 'reply', 'turn': turn_id, 'index': len(turn.messages), 'messages': [message]})
+        turn.messages.append(message)
+        self.message_log.append(message)
+
+    def set_leaf(self, turn_id):
+        """Make turn_id the end of the active branch; the next turn forks from there"""
+        self.leaf = turn_id
+        self.ops.append({'op': 'leaf', 'id': turn_id})
+
+    def switch_to(self, turn_id):
+        """Activate the branch through turn_id, following its most recent descendants"""
+        while self.children.get(turn_id):
+            turn_id = self.children[turn_id][-1]
+        self.set_leaf(turn_id)
+
+    def siblings(self, turn_id):
+        return self.children[self.turns[turn_id].parent]
+
+    def path(self):
+        """Turns of the active branch, oldest first"""
+        turns = []
+        turn_id = self.leaf
+        while turn_id is not None:
+            turn = self.turns[turn_id]
+            turns.append(turn)
+            if len(turns) > len(self.turns):
+                raise ValueError("Conversation turns form a cycle")
+            turn_id = turn.parent
+        turns.reverse()
+        return turns
+
+    def validate(self):
+        """Raise ValueError unless the leaf and every parent name a turn and each parent chain ends at a first turn"""
+        if self.turns and self.leaf not in self.turns:
+            raise ValueError(f"Unknown active turn {self.leaf!r}")
+        if sum(len(child_ids) for child_ids in self.children.values()) != len(self.turns):
+            raise ValueError("Duplicate turn ids")
+        rooted = set()  # turns whose parent chain is already known to end at a first turn
+        for turn_id in self.turns:
+            chain = set()
+            while turn_id is not None and turn_id not in rooted:
+                if turn_id in chain:
+                    raise ValueError("Conversation turns form a cycle")
+                chain.add(turn_id)
+                turn = self.turns.get(turn_id)
+                if turn is None:
+                    raise ValueError(f"Unknown parent turn {turn_id!r}")
+                turn_id = turn.parent
+            rooted |= chain
+
+    def messages(self):
+        return [message for turn in self.path() for message in turn.messages]
+
+    def append_messages(self, messages):
+        """Attach flat messages to the active branch: a user message starts a turn, replies join the current one"""
+        for message in messages:
+            if message['role'] == 'user' or self.leaf is None:
+                self.add_turn([message])
+            else:
+                self.add_reply(self.leaf, message)
+
+    def drain_ops(self):
+        ops, self.ops = self.ops, []
+        return ops
+
+    def apply(self, record):
+        """Replay a journaled change; applying one twice is harmless, even a reply that lost a race
+
+        A reply records the index it was written at. If another writer replied to the same turn first,
+        the reply ends up further along, so a replay looks for it anywhere from that index on.
+        """
+        op = record['op']
+        if op == 'turn':
+            if record['id'] not in self.turns:
+                self._add_turn(record['id'], record['parent'], record['messages'])
+        elif op == 'reply':
+            turn = self.turns.get(record['turn'])
+            if turn is None:
+                return
+            index, messages = record['index'], record['messages']
+            wanted = [msg.to_dict() for msg in messages]
+            stored = [msg.to_dict() for msg in turn.messages[index:]]
+            if not any(stored[start:start + len(wanted)] == wanted for start in range(len(stored) - len(wanted) + 1)):
+                turn.messages.extend(messages)
+                self.message_log.extend(messages)
+        elif op == 'leaf':
+            self.leaf = record['id']
+
+    def to_dict(self):
+        return {
+            'tree_id': self.tree_id,
+            'leaf': self.leaf,
+            'turns': [{'id': turn.id, 'parent': turn.parent, 'messages': list(turn.messages)}
+                      for turn in self.turns.values()]
+        }
+
+    @classmethod
+    def from_dict(cls, data, tree_id=None):
+        tree = cls(tree_id or data.get('tree_id'))
+        for turn in data['turns']:
+            tree._add_turn(turn['id'], turn['parent'], turn['messages'])
+        tree.leaf = data['leaf']
+        return tree
+
+    @classmethod
+    def from_messages(cls, messages):
+        """Single-branch tree from a flat message list, the format saved before branching"""
+        tree = cls()
+        tree.append_messages(messages)
+        tree.ops = []
+        return tree
+
+    def clone(self):
+        """Independent structure over the same immutable messages, in sync with the same journal"""
+        return ConversationTree.from_dict(self.to_dict())
+
+# Persistence
+JOURNAL_COMPACT_MIN_BYTES = 256 * 1024  # compact once the journal outgrows both this and the snapshot
+SESSION_CACHE_SIZE = 64  # per-session journals kept in memory
+STORAGE_FLUSH_INTERVAL = 0.5  # seconds journal appends are held back so bursts go out as one write
+
+def _atomic_write(path, data):
+    """Write bytes to path so that readers see either the old or the new file, never a torn one"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+@contextmanager
+def file_lock(path):
+    """Exclusive lock on a sidecar file, shared by every process serving the app"""
+    with open(path, 'a+b') as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def compress_blob(data):
+    """Compress stored bytes with zstd when available, else zlib; a one-byte tag records which"""
+    if zstandard:
+        return b'S' + zstandard.ZstdCompressor(level=3).compress(data)
+    return b'Z' + zlib.compress(data, 6)
+
+def decompress_blob(blob):
+    tag, body = blob[:1], blob[1:]
+    if tag == b'S':
+        if not zstandard:
+            raise RuntimeError("This data was stored with zstd compression: pip install zstandard")
+        return zstandard.ZstdDecompressor().decompress(body)
+    if tag == b'Z':
+        return zlib.decompress(body)
+    return blob  # plain JSON written before compression was introduced
+
+def pack_messages(messages):
+    """Storage form of messages: plain dicts without clean_content where it only repeats content"""
+    return [message.to_dict(compact=True) for message in messages]
+
+def unpack_messages(messages):
+    return [Message.from_dict(message) for message in messages]
+
+def pack_tree(tree_data):
+    return dict(tree_data, turns=[dict(turn, messages=pack_messages(turn['messages'])) for turn in tree_data['turns']])
+
+def unpack_tree(tree_data):
+    return dict(tree_data, turns=[dict(turn, messages=unpack_messages(turn['messages'])) for turn in tree_data['turns']])
+
+def encode_record(record):
+    """Storage form of a journal record"""
+    if 'messages' in record:
+        record = dict(record, messages=pack_messages(record['messages']))
+    if 'tree' in record:
+        record = dict(record, tree=pack_tree(record['tree']))
+    return record
+
+def decode_record(record):
+    if 'messages' in record:
+        record['messages'] = unpack_messages(record['messages'])
+    if 'tree' in record:
+        record['tree'] = unpack_tree(record['tree'])
+    return record
+
+def tree_from_storage(data):
+    """Conversation tree from stored state, which holds a flat message list if saved before branching"""
+    if 'tree' in data:
+        return ConversationTree.from_dict(unpack_tree(data['tree']))
+    return ConversationTree.from_messages(unpack_messages(data.get('messages', [])))
+
+# Storage backends: a snapshot blob plus an append-only list of journal lines per session key, and
+# named blobs for conversation transcripts. version() is a cheap token that changes on every journal
+# write, so callers can keep state cached in memory.
+class LocalFileBackend:
+    """Snapshot and journal files in one directory per key; shared by the processes on one machine"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _paths(self, key):
+        directory = os.path.join(self.root, key)
+        return directory, os.path.join(directory, 'snapshot.json'), os.path.join(directory, 'journal.jsonl')
+
+    @contextmanager
+    def lock(self, key):
+        directory = self._paths(key)[0]
+        os.makedirs(directory, exist_ok=True)
+        with file_lock(os.path.join(directory, '.lock')):
+            yield
+
+    def version(self, key):
+        _, snapshot_path, journal_path = self._paths(key)
+        try:
+            snapshot_mtime = os.stat(snapshot_path).st_mtime_ns
+        except FileNotFoundError:
+            snapshot_mtime = None
+        try:
+            journal_size = os.stat(journal_path).st_size
+        except FileNotFoundError:
+            journal_size = 0
+        return snapshot_mtime, journal_size
+
+    def read(self, key):
+        """(snapshot bytes or None, journal lines, version)"""
+        _, snapshot_path, journal_path = self._paths(key)
+        version = self.version(key)  # taken first, so a concurrent append only causes a spare reload
+        snapshot, lines = None, []
+        try:
+            with open(snapshot_path, 'rb') as f:
+                snapshot = f.read()
+        except FileNotFoundError:
+            pass
+        try:
+            with open(journal_path, 'rb') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            pass
+        return snapshot, lines, version
+
+    def append(self, key, lines):
+        directory, _, journal_path = self._paths(key)
+        os.makedirs(directory, exist_ok=True)
+        with open(journal_path, 'ab+') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size:
+                f.seek(size - 1)
+                if f.read(1) != b'\n':
+                    # Torn final write from a crash; drop it so the new records start on a fresh line
+                    f.seek(0)
+                    f.truncate(f.read().rfind(b'\n') + 1)
+            f.write(b''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        return self.version(key)
+
+    def replace(self, key, snapshot):
+        directory, snapshot_path, journal_path = self._paths(key)
+        os.makedirs(directory, exist_ok=True)
+        _atomic_write(snapshot_path, snapshot)
+        _atomic_write(journal_path, b'')
+        return self.version(key)
+
+    def delete(self, key):
+        for path in self._paths(key)[1:]:
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(os.path.join(self._paths(key)[0], 'transcripts'), ignore_errors=True)
+
+    def _blob_path(self, key, name):
+        return os.path.join(self._paths(key)[0], 'transcripts', f"{name}.json")
+
+    def put_blob(self, key, name, data):
+        path = self._blob_path(key, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _atomic_write(path, data)
+
+    def get_blob(self, key, name):
+        try:
+            with open(self._blob_path(key, name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete_blob(self, key, name):
+        try:
+            os.remove(self._blob_path(key, name))
+        except FileNotFoundError:
+            pass
+
+class RedisBackend:
+    """Snapshot string and journal list per key in Redis, so every app replica sees the same sessions"""
+
+    def __init__(self, url, prefix='ollama-chat:', client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError("Redis storage needs the redis package: pip install redis")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def _keys(self, key):
+        base = f"{self.prefix}{key}"
+        return f"{base}:snapshot", f"{base}:journal", f"{base}:version"
+
+    @contextmanager
+    def lock(self, key):
+        with self.client.lock(f"{self.prefix}{key}:lock", timeout=30, blocking_timeout=10):
+            yield
+
+    def version(self, key):
+        return self.client.get(self._keys(key)[2])
+
+    def read(self, key):
+        snapshot_key, journal_key, version_key = self._keys(key)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.get(snapshot_key)
+        pipe.lrange(journal_key, 0, -1)
+        pipe.get(version_key)
+        return tuple(pipe.execute())
+
+    def append(self, key, lines):
+        _, journal_key, version_key = self._keys(key)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.rpush(journal_key, *lines)
+        pipe.incr(version_key)
+        return str(pipe.execute()[-1]).encode()
+
+    def replace(self, key, snapshot):
+        snapshot_key, journal_key, version_key = self._keys(key)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.set(snapshot_key, snapshot)
+        pipe.delete(journal_key)
+        pipe.incr(version_key)
+        return str(pipe.execute()[-1]).encode()
+
+    def delete(self, key):
+        self.client.delete(*self._keys(key), self._transcripts_key(key))
+
+    def _transcripts_key(self, key):
+        return f"{self.prefix}{key}:transcripts"
+
+    def put_blob(self, key, name, data):
+        self.client.hset(self._transcripts_key(key), name, data)
+
+    def get_blob(self, key, name):
+        return self.client.hget(self._transcripts_key(key), name)
+
+    def delete_blob(self, key, name):
+        self.client.hdel(self._transcripts_key(key), name)
+
+class ConversationJournal:
+    """Append-only conversation store: a JSON snapshot plus a JSONL journal of the changes made since
+
+    Every record carries a sequence number and the snapshot remembers the last one it includes,
+    so a crash at any point of a compaction never loses or replays a change twice. The state is
+    cached in memory and only re-read when the backend version moves. Records are staged in
+    memory and written out in batches by the WriteBatcher.
+    """
+
+    def __init__(self, backend, key, batcher):
+        self.backend = backend
+        self.key = key
+        self.batcher = batcher
+        self.lock = threading.RLock()
+        self.state = None           # materialized state: settings, conversation tree, history index
+        self.found = False          # whether anything was stored when the state was loaded
+        self.version = None         # backend version the in-memory state matches
+        self.pending = []           # staged records not yet written to the backend
+        self.write_error = None     # last background write failure, surfaced on the next save
+        self.seq = 0
+        self.snapshot_bytes = 0
+        self.journal_bytes = 0
+
+    def _reload(self):
+        state = {'settings': {}, 'tree': ConversationTree(), 'history': {}}
+        self.seq = self.snapshot_bytes = self.journal_bytes = 0
+        snapshot, lines, self.version = self.backend.read(self.key)
+        found = False
+        if snapshot:
+            data = json.loads(decompress_blob(snapshot))
+            state['settings'] = data['state']['settings']
+            state['history'] = data['state']['history']
+            state['tree'] = tree_from_storage(data['state'])
+            self.seq = data['seq']
+            self.snapshot_bytes = len(snapshot)
+            found = True
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break  # torn final write from a crash; the next append drops it
+            self.journal_bytes += len(line)
+            if record['seq'] > self.seq:
+                self._replay(state, decode_record(record))
+                self.seq = record['seq']
+                found = True
+        self.state = state
+        self.found = found
+
+    def _ensure_current(self):
+        """Reload unless the cached state still matches the backend (caller holds the lock)"""
+        if self.pending:
+            return  # our own unwritten records are newer than anything stored; flush() reconciles
+        if self.state is None or self.backend.version(self.key) != self.version:
+            self._reload()
+
+    def _replay(self, state, record):
+        op = record['op']
+        if op == 'settings':
+            state['settings'] = record['settings']
+        elif op in ('turn', 'reply', 'leaf'):
+            state['tree'].apply(record)
+        elif op == 'reset':
+            state['tree'] = (ConversationTree.from_dict(record['tree']) if 'tree' in record
+                             else ConversationTree.from_messages(record['messages']))
+        elif op == 'append':  # journals written before branching
+            state['tree'].append_messages(record['messages'])
+            state['tree'].drain_ops()
+        elif op == 'history_put':
+            # Insertion order is recency, so re-saving an entry moves it to the top
+            state['history'].pop(record['entry']['id'], None)
+            state['history'][record['entry']['id']] = record['entry']
+        elif op == 'history_touch':
+            entry = state['history'].get(record['id'])
+            if entry:
+                entry['accessed'] = record['accessed']
+        elif op == 'history_delete':
+            state['history'].pop(record['id'], None)
+
+    def load(self):
+        """Current state from the snapshot and journal; None if nothing was ever saved"""
+        with self.lock:
+            self._ensure_current()
+            return self.state if self.found else None
+
+    def _stage(self, record):
+        self.seq += 1
+        record['seq'] = self.seq
+        self._replay(self.state, record)
+        self.pending.append(record)
+        self.found = True
+
+    def _append(self, records):
+        """Apply records to the in-memory state and queue them for the next batched write"""
+        with self.lock:
+            self._ensure_current()
+            for record in records:
+                self._stage(record)
+        self.batcher.mark(self)
+
+    def flush(self):
+        """Write staged records to the backend in one append, compacting when the journal has grown"""
+        with self.lock:
+            if not self.pending:
+                return
+            with self.backend.lock(self.key):
+                if self.backend.version(self.key) != self.version:
+                    # Another process or replica wrote meanwhile: rebuild from its state and re-apply ours on top
+                    pending, self.pending = self.pending, []
+                    self._reload()
+                    for record in pending:
+                        self._stage(record)
+                lines = [(json.dumps(encode_record(record), separators=(',', ':')) + '\n').encode('utf-8')
+                         for record in self.pending]
+                self.version = self.backend.append(self.key, lines)
+                self.pending = []
+                self.journal_bytes += sum(len(line) for line in lines)
+                if self.journal_bytes > max(JOURNAL_COMPACT_MIN_BYTES, self.snapshot_bytes):
+                    self._compact()
+
+    def sync(self, tree, settings):
+        """Journal only what changed: the tree's queued changes (or all of it if it is a different tree) and settings"""
+        with self.lock:
+            self._ensure_current()
+            state = self.state
+            records = []
+            if tree.tree_id == state['tree'].tree_id:
+                records.extend(tree.drain_ops())
+            else:
+                tree.drain_ops()  # superseded by the full copy
+                records.append({'op': 'reset', 'tree': tree.to_dict()})
+            if settings != state['settings']:
+                # Detach from session state so later in-place edits still show up as changes
+                records.append({'op': 'settings', 'settings': json.loads(json.dumps(settings))})
+            if records:
+                self._append(records)
+
+    def get_history(self, conversation_id):
+        with self.lock:
+            self._ensure_current()
+            return self.state['history'].get(conversation_id)
+
+    def history_ids(self):
+        with self.lock:
+            self._ensure_current()
+            return set(self.state['history'])
+
+    def history_entries(self):
+        """Metadata of every saved conversation, newest first"""
+        with self.lock:
+            self._ensure_current()
+            return list(reversed(self.state['history'].values()))
+
+    def history_page(self, page, page_size):
+        """Newest-first page of history metadata and the total number of entries"""
+        with self.lock:
+            self._ensure_current()
+            history = self.state['history']
+            start = page * page_size
+            return list(islice(reversed(history.values()), start, start + page_size)), len(history)
+
+    def put_history(self, entry, transcript):
+        """Store the full transcript out of line and compressed, then index only its metadata"""
+        transcript = dict(transcript, tree=pack_tree(transcript['tree']))
+        data = compress_blob(json.dumps(transcript, separators=(',', ':')).encode('utf-8'))
+        self.backend.put_blob(self.key, entry['id'], data)
+        self._append([{'op': 'history_put', 'entry': dict(entry, bytes=len(data), accessed=time.time())}])
+
+    def load_transcript(self, conversation_id):
+        data = self.backend.get_blob(self.key, conversation_id)
+        if not data:
+            return None
+        transcript = json.loads(decompress_blob(data))
+        # A fresh tree id, so the journal copies the loaded tree in full rather than diffing it
+        transcript['tree'] = tree_from_storage(transcript)
+        transcript['tree'].tree_id = uuid.uuid4().hex
+        return transcript
+
+    def touch_history(self, conversation_id):
+        """Mark a conversation as revisited, so eviction keeps it"""
+        self._append([{'op': 'history_touch', 'id': conversation_id, 'accessed': time.time()}])
+
+    def evict_history(self, byte_budget, keep=None):
+        """Delete least recently used conversations until the stored transcripts fit the budget; returns their ids"""
+        with self.lock:
+            self._ensure_current()
+            history = self.state['history']
+            total = sum(entry.get('bytes', 0) for entry in history.values())
+            if total <= byte_budget:
+                return []
+            evicted = []
+            for entry in sorted(history.values(), key=lambda entry: entry.get('accessed', 0)):
+                if total <= byte_budget:
+                    break
+                if entry['id'] == keep:
+                    continue
+                evicted.append(entry['id'])
+                total -= entry.get('bytes', 0)
+        for conversation_id in evicted:
+            self.delete_history(conversation_id)
+        return evicted
+
+    def delete_history(self, conversation_id):
+        self._append([{'op': 'history_delete', 'id': conversation_id}])
+        self.backend.delete_blob(self.key, conversation_id)
+
+    def _compact(self):
+        """Fold the journal into a new snapshot (caller holds both locks and has nothing pending)"""
+        state = dict(self.state, tree=pack_tree(self.state['tree'].to_dict()))
+        data = compress_blob(json.dumps({'seq': self.seq, 'state': state, 'timestamp': datetime.now().isoformat()},
+                                        separators=(',', ':')).encode('utf-8'))
+        self.version = self.backend.replace(self.key, data)
+        self.snapshot_bytes = len(data)
+        self.journal_bytes = 0
+
+    def replace_state(self, state):
+        """Overwrite everything stored for this key with state"""
+        with self.lock, self.backend.lock(self.key):
+            self.pending = []
+            self.state = state
+            self.found = True
+            self._compact()
+
+    def clear(self):
+        with self.lock, self.backend.lock(self.key):
+            self.backend.delete(self.key)
+            self.pending = []
+            self.state = None
+            self.found = False
+            self.version = None
+            self.seq = 0
+            self.snapshot_bytes = self.journal_bytes = 0
+
+class WriteBatcher:
+    """Background writer that coalesces the journal appends of each interval into one backend write"""
+
+    def __init__(self, interval=STORAGE_FLUSH_INTERVAL):
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.dirty = set()
+        threading.Thread(target=self._run, daemon=True).start()
+        atexit.register(self.flush_all)
+
+    def mark(self, journal):
+        with self.cond:
+            self.dirty.add(journal)
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.dirty:
+                    self.cond.wait()
+            time.sleep(self.interval)  # let the rest of the burst pile up
+            self.flush_all()
+
+    def flush_all(self):
+        with self.cond:
+            dirty, self.dirty = self.dirty, set()
+        for journal in dirty:
+            try:
+                journal.flush()
+                journal.write_error = None
+            except Exception as e:
+                journal.write_error = e
+                with self.cond:
+                    self.dirty.add(journal)  # retried on the next round
+
+class SessionStore:
+    """LRU of per-session journals, so hot sessions are served from memory instead of replayed from storage"""
+
+    def __init__(self, backend, batcher, capacity=SESSION_CACHE_SIZE):
+        self.backend = backend
+        self.batcher = batcher
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.journals = OrderedDict()
+
+    def journal(self, key):
+        with self.lock:
+            journal = self.journals.pop(key, None)
+            if journal is None:
+                journal = ConversationJournal(self.backend, key, self.batcher)
+            self.journals[key] = journal
+            if len(self.journals) > self.capacity:
+                # Evicted sessions reload from storage on next use; the batcher still flushes their writes
+                self.journals.popitem(last=False)
+            return journal
+
+# Thinking token parsing
+THINKING_TAGS = {'<think>': '</think>', '<thinking>': '</thinking>'}
+
+def _partial_tag_length(text, tags):
+    """Length of the longest suffix of text that could be the beginning of one of the tags"""
+    longest = 0
+    for tag in tags:
+        for size in range(min(len(tag) - 1, len(text)), longest, -1):
+            if text.endswith(tag[:size]):
+                longest = size
+                break
+    return longest
+
+class ThinkingStreamParser:
+    """Split streamed text into answer and <think>/<thinking> reasoning as chunks arrive (for models like deepseek-r1)"""
+
+    def __init__(self):
+        self.answer = ""
+        self.thinking = ""
+        self.pending = ""       # held back because it may be the start of a tag split across chunks
+        self.close_tag = None   # set while inside a reasoning block
+
+    def _start_thinking_block(self):
+        if self.thinking and not self.thinking.endswith("\n\n"):
+            self.thinking += "\n\n"
+
+    def feed(self, content, native_thinking=None):
+        """Consume one chunk (plus Ollama's native message.thinking, if any) and return the new (answer, thinking) text"""
+        answer_start, thinking_start = len(self.answer), len(self.thinking)
+        if native_thinking:
+            self.thinking += native_thinking
+
+        text = self.pending + (content or "")
+        self.pending = ""
+        while text:
+            if self.close_tag:
+                end = text.find(self.close_tag)
+                if end == -1:
+                    keep = _partial_tag_length(text, [self.close_tag])
+                    self.thinking += text[:len(text) - keep]
+                    self.pending = text[len(text) - keep:]
+                    break
+                self.thinking += text[:end]
+                text = text[end + len(self.close_tag):]
+                self.close_tag = None
+            else:
+                starts = [(text.find(tag), tag) for tag in THINKING_TAGS if tag in text]
+                if not starts:
+                    keep = _partial_tag_length(text, THINKING_TAGS)
+                    self.answer += text[:len(text) - keep]
+                    self.pending = text[len(text) - keep:]
+                    break
+                start, tag = min(starts)
+                self.answer += text[:start]
+                self._start_thinking_block()
+                text = text[start + len(tag):]
+                self.close_tag = THINKING_TAGS[tag]
+
+        return self.answer[answer_start:], self.thinking[thinking_start:]
+
+    def finish(self):
+        """Flush held-back text at end of stream and return (clean_content, thinking or None)"""
+        if self.close_tag:
+            self.thinking += self.pending
+        else:
+            self.answer += self.pending
+        self.pending = ""
+        return self.answer.strip(), self.thinking.strip() or None
+
+# Generation scheduling
+class GenerationScheduler:
+    """Process-wide admission control between every session's generation jobs and the Ollama nodes
+
+    A job runs only when a node that can serve its model has a free slot, both for that model
+    (OLLAMA_NUM_PARALLEL) and overall. Waiting jobs are queued per session, and sessions take turns
+    starting one job each, least recently served first, so a comparison fanning out to many models
+    gets no more than its share.
+    """
+
+    def __init__(self, executor, model_slots, node_slots):
+        self.executor = executor
+        self.probing = set()                    # routers being probed off the lock before their jobs are placed
+        self.model_slots = model_slots
+        self.node_slots = node_slots
+        self.lock = threading.RLock()
+        self.queues = {}                        # session -> waiting jobs, in arrival order
+        self.last_turn = {}                     # session -> turn number of its most recently started job
+        self.turns = 0
+        self.session_running = defaultdict(int)
+        self.node_running = defaultdict(int)   # base URL -> admitted jobs
+        self.model_running = defaultdict(int)  # (base URL, model) -> admitted jobs
+        self.durations = {}                     # model -> moving average of generation time, for wait estimates
+
+    def submit(self, job):
+        job.scheduler = self
+        job.router.node_results()  # probe now, outside the lock: placement under it only reads cached results
+        with self.lock:
+            self.queues.setdefault(job.session, deque()).append(job)
+            self._dispatch()
+
+    def withdraw(self, job):
+        """Drop a job that has not started yet"""
+        with self.lock:
+            queue = self.queues.get(job.session)
+            if not queue or job not in queue:
+                return
+            queue.remove(job)
+            if not queue:
+                del self.queues[job.session]
+        job.stopped = True
+        job.done.set()
+
+    def _has_slot(self, model):
+        return lambda node: (self.node_running[node.base_url] < self.node_slots
+                             and self.model_running[(node.base_url, model)] < self.model_slots)
+
+    def _place(self, job):
+        """(admit, node) for a waiting job; a job no node can serve is admitted at once to fail fast"""
+        router = job.router
+        node = router.pick(job.model, available=self._has_slot(job.model), cached_only=True)
+        if node is not None:
+            return True, node
+        if router.pick(job.model, cached_only=True) is not None:
+            return False, None
+        if router.probed():
+            return True, None
+        # Some node has no probe result (e.g. just invalidated): probe it off the lock, then place again
+        if router not in self.probing:
+            self.probing.add(router)
+            threading.Thread(target=self._probe, args=(router,), name="scheduler-probe", daemon=True).start()
+        return False, None
+
+    def _probe(self, router):
+        try:
+            router.node_results()
+        finally:
+            with self.lock:
+                self.probing.discard(router)
+                self._dispatch()
+
+    def _turn_order(self):
+        """Sessions with waiting jobs, least recently served first"""
+        return sorted(self.queues, key=lambda session: self.last_turn.get(session, 0))
+
+    def _dispatch(self):
+        """Admit waiting jobs while slots are free, one per session per round (caller holds the lock)"""
+        admitted = True
+        while admitted:
+            admitted = False
+            for session in self._turn_order():
+                queue = self.queues[session]
+                if self.session_running[session] >= queue[0].max_parallel:
+                    continue
+                # The session's first job that fits, so one model at capacity doesn't hold up its others
+                for job in queue:
+                    admit, node = self._place(job)
+                    if admit:
+                        break
+                else:
+                    continue
+                queue.remove(job)
+                if not queue:
+                    del self.queues[session]
+                self._start(job, node)
+                admitted = True
+
+    def _start(self, job, node):
+        self.turns += 1
+        self.last_turn[job.session] = self.turns
+        self.session_running[job.session] += 1
+        if node is not None:
+            self.node_running[node.base_url] += 1
+            self.model_running[(node.base_url, job.model)] += 1
+        job.started.set()
+        self.executor.submit(self._run, job, node)
+
+    def _run(self, job, node):
+        try:
+            job.run(node)
+        finally:
+            with self.lock:
+                self.session_running[job.session] -= 1
+                if node is not None:
+                    self.node_running[node.base_url] -= 1
+                    self.model_running[(node.base_url, job.model)] -= 1
+                latency = job.stats.get('latency')
+                if latency and not job.stopped:
+                    previous = self.durations.get(job.model)
+                    self.durations[job.model] = latency if previous is None else 0.7 * previous + 0.3 * latency
+                self._dispatch()
+
+    def queue_status(self, job):
+        """(position among jobs waiting for the same model, estimated seconds or None), or None once started"""
+        with self.lock:
+            queue = self.queues.get(job.session)
+            if not queue or job not in queue:
+                return None
+            # The order waiting jobs get in if slots free up one at a time: one per session per round
+            queues = [self.queues[session] for session in self._turn_order()]
+            waiting = [other for round_jobs in zip_longest(*queues)
+                       for other in round_jobs if other is not None and other.model == job.model]
+            position = waiting.index(job) + 1
+            duration = self.durations.get(job.model)
+        if duration is None:
+            return position, None
+        slots = self.model_slots * max(1, len(job.router.healthy_nodes(job.model)))
+        return position, duration * -(-position // slots)
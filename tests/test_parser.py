@@ -0,0 +1,45 @@
+import pytest
+
+from ollama_chat_core import ThinkingStreamParser
+
+
+def parse(chunks):
+    parser = ThinkingStreamParser()
+    answer = thinking = ""
+    for chunk in chunks:
+        new_answer, new_thinking = parser.feed(chunk)
+        answer += new_answer
+        thinking += new_thinking
+    clean, final_thinking = parser.finish()
+    return answer, thinking, clean, final_thinking
+
+
+def test_tags_in_one_chunk():
+    assert parse(["<think>plan</think>Answer"])[2:] == ("Answer", "plan")
+
+
+@pytest.mark.parametrize('split', range(1, len("<think>plan</think>Answer")))
+def test_tags_split_across_two_chunks(split):
+    text = "<think>plan</think>Answer"
+    assert parse([text[:split], text[split:]])[2:] == ("Answer", "plan")
+
+
+def test_tags_split_one_character_per_chunk():
+    answer, thinking, clean, final_thinking = parse(list("Intro <thinking>step one</thinking> done"))
+    assert (clean, final_thinking) == ("Intro  done", "step one")
+    # Nothing that belongs to a tag ever leaks into the streamed text
+    assert "<" not in answer and "<" not in thinking
+
+
+def test_partial_tag_prefix_that_is_not_a_tag_is_released():
+    assert parse(["a <th", "en b"])[2:] == ("a <then b", None)
+
+
+def test_unclosed_block_at_end_of_stream_counts_as_thinking():
+    assert parse(["<think>still going </thi"])[2:] == ("", "still going </thi")
+
+
+def test_native_thinking_is_kept_apart_from_answer():
+    parser = ThinkingStreamParser()
+    assert parser.feed("Hi", native_thinking="hmm") == ("Hi", "hmm")
+    assert parser.finish() == ("Hi", "hmm")
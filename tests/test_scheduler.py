@@ -0,0 +1,170 @@
+import threading
+
+from ollama_chat_core import GenerationScheduler
+
+
+class Node:
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+
+class Router:
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.known = list(nodes)  # nodes with a probe result, as seen by cached_only picks
+        self.probes = 0
+
+    def node_results(self, cached_only=False):
+        if not cached_only:
+            self.probes += 1
+            self.known = list(self.nodes)
+        return [(node, {}) for node in self.known]
+
+    def probed(self):
+        return len(self.known) == len(self.nodes)
+
+    def pick(self, model, available=None, cached_only=False):
+        for node, _ in self.node_results(cached_only):
+            if available is None or available(node):
+                return node
+        return None
+
+    def healthy_nodes(self, model):
+        return self.nodes
+
+
+class Job:
+    def __init__(self, router, session, model, max_parallel=4):
+        self.router = router
+        self.session = session
+        self.model = model
+        self.max_parallel = max_parallel
+        self.started = threading.Event()
+        self.done = threading.Event()
+        self.stopped = False
+        self.stats = {}
+        self.node = None
+
+    def run(self, node):
+        self.node = node
+        self.done.set()
+
+
+class ManualExecutor:
+    """Holds submitted jobs until the test finishes them, so the order of admission is observable"""
+
+    def __init__(self):
+        self.running = []
+
+    def submit(self, fn, *args):
+        self.running.append((fn, args))
+
+    def finish_oldest(self):
+        fn, args = self.running.pop(0)
+        fn(*args)
+        return args[0]
+
+
+def make_scheduler(model_slots=1, node_slots=1, nodes=('http://a',)):
+    executor = ManualExecutor()
+    return GenerationScheduler(executor, model_slots, node_slots), executor, Router([Node(url) for url in nodes])
+
+
+def test_sessions_take_turns():
+    scheduler, executor, router = make_scheduler()
+    a_jobs = [Job(router, 'a', 'llama3') for _ in range(3)]
+    b_jobs = [Job(router, 'b', 'llama3') for _ in range(2)]
+    for job in a_jobs + b_jobs:
+        scheduler.submit(job)
+
+    order = []
+    while executor.running:
+        order.append(executor.finish_oldest())
+    # Session a queued first, but once it has had a turn b goes next, and so on
+    assert order == [a_jobs[0], b_jobs[0], a_jobs[1], b_jobs[1], a_jobs[2]]
+
+
+def test_queue_status_follows_turn_order():
+    scheduler, executor, router = make_scheduler()
+    running = Job(router, 'a', 'llama3')
+    a_next, b_next = Job(router, 'a', 'llama3'), Job(router, 'b', 'llama3')
+    for job in (running, a_next, b_next):
+        scheduler.submit(job)
+
+    assert scheduler.queue_status(running) is None
+    assert scheduler.queue_status(b_next) == (1, None)
+    assert scheduler.queue_status(a_next) == (2, None)
+
+
+def test_model_at_capacity_does_not_block_other_models():
+    scheduler, executor, router = make_scheduler(model_slots=1, node_slots=2)
+    first, same_model, other_model = (Job(router, 'a', 'llama3'), Job(router, 'a', 'llama3'),
+                                      Job(router, 'a', 'mistral'))
+    for job in (first, same_model, other_model):
+        scheduler.submit(job)
+
+    assert first.started.is_set() and other_model.started.is_set()
+    assert not same_model.started.is_set()
+    executor.finish_oldest()
+    assert same_model.started.is_set()
+
+
+def test_session_parallel_limit():
+    scheduler, executor, router = make_scheduler(model_slots=4, node_slots=4)
+    jobs = [Job(router, 'a', 'llama3', max_parallel=2) for _ in range(3)]
+    for job in jobs:
+        scheduler.submit(job)
+
+    assert [job.started.is_set() for job in jobs] == [True, True, False]
+
+
+def test_job_without_a_node_is_admitted_to_fail_fast():
+    scheduler, executor, router = make_scheduler(nodes=())
+    job = Job(router, 'a', 'llama3')
+    scheduler.submit(job)
+
+    assert job.started.is_set()
+    executor.finish_oldest()
+    assert job.node is None
+
+
+def test_withdraw_drops_a_waiting_job():
+    scheduler, executor, router = make_scheduler()
+    running, waiting = Job(router, 'a', 'llama3'), Job(router, 'b', 'llama3')
+    scheduler.submit(running)
+    scheduler.submit(waiting)
+    scheduler.withdraw(waiting)
+
+    assert waiting.done.is_set() and waiting.stopped
+    executor.finish_oldest()
+    assert not executor.running
+
+
+def test_unprobed_nodes_are_probed_off_the_lock_before_placing():
+    scheduler, executor, router = make_scheduler()
+    running, waiting = Job(router, 'a', 'llama3'), Job(router, 'b', 'llama3')
+    scheduler.submit(running)
+    scheduler.submit(waiting)
+    router.known = []  # probe results invalidated, e.g. after a model was pulled
+
+    blocked = threading.Event()
+    original = router.node_results
+
+    def slow_node_results(cached_only=False):
+        if not cached_only:
+            blocked.wait(5)
+        return original(cached_only)
+    router.node_results = slow_node_results
+
+    finisher = threading.Thread(target=executor.finish_oldest)
+    finisher.start()
+    finisher.join(5)
+    # The waiting job is neither admitted blind nor holding up the finished one while the probe runs
+    assert not finisher.is_alive()
+    assert not waiting.started.is_set()
+    with scheduler.lock:
+        pass  # the lock is free while the probe is blocked
+
+    blocked.set()
+    assert waiting.started.wait(5)
+    assert executor.running[0][1] == (waiting, router.nodes[0])
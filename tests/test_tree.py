@@ -0,0 +1,64 @@
+import pytest
+
+from ollama_chat_core import ConversationTree, Message
+
+
+def tree_data(turns, leaf):
+    return {'tree_id': 't', 'leaf': leaf,
+            'turns': [{'id': turn_id, 'parent': parent, 'messages': [Message('user', turn_id)]}
+                      for turn_id, parent in turns]}
+
+
+def test_branches_share_their_prefix():
+    tree = ConversationTree()
+    root = tree.add_turn([Message('user', 'q')])
+    first = tree.add_turn([Message('user', 'a')])
+    second = tree.add_turn([Message('user', 'b')], parent=root.id)
+    assert [m['content'] for m in tree.messages()] == ['q', 'b']
+
+    tree.switch_to(first.id)
+    assert [m['content'] for m in tree.messages()] == ['q', 'a']
+    assert tree.siblings(second.id) == [first.id, second.id]
+    tree.validate()
+
+
+def test_replayed_ops_rebuild_the_tree():
+    tree = ConversationTree()
+    turn = tree.add_turn([Message('user', 'q')])
+    tree.add_reply(turn.id, Message('assistant', 'a'))
+    copy = ConversationTree()
+    for op in tree.drain_ops():
+        copy.apply(op)
+    assert copy.to_dict()['turns'] == tree.to_dict()['turns']
+    assert copy.leaf == tree.leaf
+
+
+@pytest.mark.parametrize('turns, leaf', [
+    ([('a', None)], 'missing'),                 # leaf is not a turn
+    ([('a', None), ('b', 'missing')], 'b'),     # dangling parent
+    ([('a', 'b'), ('b', 'a')], 'a'),            # two turns parenting each other
+    ([('a', None), ('b', 'b')], 'a'),           # self-parented turn off the active branch
+    ([('a', None), ('a', None)], 'a'),          # duplicate id
+])
+def test_validate_rejects_broken_structure(turns, leaf):
+    tree = ConversationTree.from_dict(tree_data(turns, leaf))
+    with pytest.raises(ValueError):
+        tree.validate()
+
+
+def test_path_stops_at_a_cycle():
+    tree = ConversationTree.from_dict(tree_data([('a', 'b'), ('b', 'a')], 'a'))
+    with pytest.raises(ValueError):
+        tree.path()
+
+
+def test_replaying_a_reply_that_lost_a_race_is_harmless():
+    tree = ConversationTree()
+    turn = tree.add_turn([Message('user', 'q')])
+    tree.drain_ops()
+    first = {'op': 'reply', 'turn': turn.id, 'index': 1, 'messages': [Message('assistant', 'from a')]}
+    second = {'op': 'reply', 'turn': turn.id, 'index': 1, 'messages': [Message('assistant', 'from b')]}
+    for record in (first, second, second, first):
+        tree.apply(record)
+    assert [m['content'] for m in tree.turns[turn.id].messages] == ['q', 'from a', 'from b']
+    assert len(tree.message_log) == 3